@@ -1,47 +1,67 @@
-from dash import Dash, html, dcc, dash_table
+from dash import Dash, html, dcc, dash_table, Patch, ctx, no_update
 import dash_auth
-import plotly.express as px
 import pandas as pd
+import numpy as np
 import dash_helpers as dh
+import dash_store as store
+import dash_cache
+import dash_metrics as metrics
+import dash_precompute
+from dash_panels import PANELS, TABLE_PANELS, DEFAULT_STOPS, PLOT_POINTS, STREAMING
 import dash_bootstrap_components as dbc
 from dash.dependencies import Input, Output, State
 from random import randint
-import re
 import dash_daq as daq
 import os
-import base64
-import json
-import boto3
+import io
+import hashlib
+from functools import lru_cache
+from urllib.parse import quote
+from flask import Response, abort, request, jsonify
+import threading
+from collections import deque
+import time
+import gc
+import copy
 
 app = Dash(__name__, external_stylesheets=[dbc.themes.LUX])
 
-# with open('/Users/gabrieltaylor/Python/Claire/pass_keys.json') as f:
-#     VALID_USERNAME_PASSWORD_PAIRS = json.load(f)
+log = metrics.setup_logging()
+metrics.instrument_callbacks(app.server)
 
-s3 = boto3.resource('s3')
-obj = s3.Object('claireandgabriel1year.com', 'pass_keys.json')
-content = obj.get()['Body'].read().decode('utf-8')
-VALID_USERNAME_PASSWORD_PAIRS = json.loads(content)
+# Point CLAIRE_PASS_KEYS at a local pass_keys.json to run offline. The keys
+# are fetched on a background thread alongside the messages, so a cold start
+# waits on the slower of the two rather than both in turn. A login waits for
+# that fetch instead of starting another, and a failed fetch is retried on
+# the next login.
 
+_pass_keys_lock = threading.Lock()
+
+@lru_cache(maxsize = 1)
+def fetch_pass_keys():
+    return store.load_pass_keys()
+
+def valid_username_password_pairs():
+    with _pass_keys_lock:
+        return fetch_pass_keys()
+
+def prefetch_pass_keys():
+    try:
+        valid_username_password_pairs()
+    except Exception:
+        log.exception('pass keys fetch failed')
+
+threading.Thread(target = prefetch_pass_keys, daemon = True).start()
+
+def check_password(username, password):
+    pairs = valid_username_password_pairs()
+    return username in pairs and pairs[username] == password
 
 auth = dash_auth.BasicAuth(
     app,
-    VALID_USERNAME_PASSWORD_PAIRS
+    auth_func = check_password
 )
 
-##########################
-# Read in Data and Clean #
-##########################
-
-# df = pd.read_csv('/Users/gabrieltaylor/Python/Claire/Messages - Claire Robinson.csv')
-df = pd.read_csv('s3://claireandgabriel1year.com/Messages - Claire Robinson.csv')
-df['Message Date'] = df['Message Date'].apply(pd.to_datetime)
-df['Day'] = df['Message Date'].dt.date
-df['Time'] = df['Message Date'].dt.time
-df['Hour'] = df['Message Date'].dt.hour
-df['Type'] = df['Type'].apply(lambda x: 'Claire' if x == 'Incoming' else 'Gabe')
-df.Text = df.Text.apply(lambda x: re.sub('“.*?”', '', x) if not pd.isnull(x) else x)
-
 ##########################
 # Pics ###################
 ##########################
@@ -49,37 +69,313 @@ df.Text = df.Text.apply(lambda x: re.sub('“.*?”', '', x) if not pd.isnull(x)
 pictures = os.listdir('assets')
 pictures.remove('.ipynb_checkpoints')
 
+# Each picture is decoded and shrunk to the display width once, kept in a
+# small LRU and served from /pics with long-lived caching headers, so a
+# rotation only sends a URL and browsers fetch each picture at most once.
+
+PIC_WIDTH = 600
+PIC_MAX_AGE = 7 * 24 * 3600
+
+@lru_cache(maxsize = 32)
+def resized_picture(name, width = PIC_WIDTH):
+    from PIL import Image, ImageOps
+
+    with Image.open(os.path.join('assets', name)) as img:
+        img = ImageOps.exif_transpose(img).convert('RGB')
+        img.thumbnail((width, width * 4))
+        buf = io.BytesIO()
+        img.save(buf, format = 'JPEG', quality = 85, optimize = True)
+    data = buf.getvalue()
+    return data, hashlib.md5(data).hexdigest()
+
+@app.server.route('/pics/<name>')
+def serve_picture(name):
+    if name not in pictures:
+        abort(404)
+    data, etag = resized_picture(name)
+    if etag in request.if_none_match:
+        return Response(status = 304, headers = {'ETag': f'"{etag}"'})
+    return Response(data, mimetype = 'image/jpeg',
+                    headers = {'ETag': f'"{etag}"', 'Cache-Control': f'public, max-age={PIC_MAX_AGE}'})
+
 
 ##########################
 # Figs ###################
 ##########################
 
-day_ts_fig = dh.plot_by_day(df)
-hour_ts_fig = dh.plot_by_hour(df)
-word_tbl = dh.words_table(df)
-txt_dist, wd_dist = dh.text_length(df)
-emots_fig, emots_df = dh.emoji_cnt(df)
-ngrams_fig = dh.ngram_cnt(df)
+# Every panel (see dash_panels, which also reads CLAIRE_STREAMING) is built
+# the first time a callback asks for it and then reused, so the server binds
+# its port before any figure work and a worker only pays for the panels it
+# actually serves.
+
+# Every conversation the deployment serves (see dash_store.conversations) has
+# its own panels, built when someone first picks it. Open pages poll for
+# their conversation's version, which counts as use; a worker drops the
+# panels of conversations unused for CLAIRE_CONVERSATION_TTL seconds or
+# beyond the CLAIRE_CONVERSATIONS_KEPT used last, and only refreshes the
+# rest. The first conversation, the one new visitors land on, is kept on
+# top of those. Builders take the conversation's name.
+
+CONVERSATIONS = store.conversations()
+FIRST_CONVERSATION = next(iter(CONVERSATIONS))
+CONVERSATIONS_KEPT = max(int(os.environ.get('CLAIRE_CONVERSATIONS_KEPT', '3')), 1)
+CONVERSATION_TTL = float(os.environ.get('CLAIRE_CONVERSATION_TTL', '3600'))
+
+_panels = {}
+_panel_locks = {}
+_last_used = {}
+
+def panel(name, c = None):
+    c = c or FIRST_CONVERSATION
+    panels = _panels.setdefault(c, {})
+    if name not in panels:
+        with _panel_locks.setdefault((c, name), threading.Lock()):
+            if name not in panels:
+                with metrics.PANEL_SECONDS.time(name):
+                    panels[name] = PANELS[name](lambda other: panel(other, c), CONVERSATIONS[c])
+    return panels[name]
+
+def used(c):
+    _last_used[c] = time.monotonic()
+    return c
+
+def evict_idle():
+    ### Most recently used first, so the one a page just polled for stays
+    now = time.monotonic()
+    recent = sorted((c for c in list(_panels) if c != FIRST_CONVERSATION), key = lambda c: -_last_used.get(c, 0))
+    for rank, c in enumerate(recent):
+        if rank >= CONVERSATIONS_KEPT or now - _last_used.get(c, 0) > CONVERSATION_TTL:
+            _panels.pop(c, None)
+            for key in [k for k in list(_panel_locks) if k[0] == c]:
+                _panel_locks.pop(key, None)
+            log.info('conversation dropped', extra = {'fields': {'conversation': c}})
+
+def messages(c = None):
+    return panel('messages', c)
+
+def summary(c = None):
+    return panel('summary', c)
+
+def snippets(c = None, rng = None):
+    if STREAMING:
+        data = summary(c).snippet_payload()
+        return {'senders': data['senders'], 'windows': [w for w in data['windows'] if in_range(w['day'], rng)]}
+    return dh.sample_snippets(ranged('messages', c, rng))
+
+### Start reading the messages in the background while the server comes up,
+### unless preload() is going to build them on a process pool
+if not dash_precompute.pool_size(len(TABLE_PANELS)):
+    threading.Thread(target = panel, args = ('summary',), daemon = True).start()
+
 #############################
+# Refresh ###################
+#############################
+
+# Every CLAIRE_REFRESH_SECONDS (0 turns it off) a background thread in each
+# process checks the source. Rows appended since the last check are cleaned
+# and folded into a copy of the summary, the costly panels are rebuilt on
+# that thread and the lot is swapped in at once; the cheap ones follow on
+# their next use. Anything other than an append reloads from scratch. The
+# page polls for the data version on the same interval and redraws when it
+# changes, so no request ever waits on the source.
+
+REFRESH_SECONDS = float(os.environ.get('CLAIRE_REFRESH_SECONDS', '60'))
+
+_refresh_lock = threading.Lock()
+_refresh_wake = threading.Event()
+_refresher = {'pid': None}
+
+def refresh(c = None):
+    c = c or FIRST_CONVERSATION
+    source = CONVERSATIONS[c]
+    if STREAMING:
+        current = summary(c)
+        stamp = source.stamp()
+        if current.stamp == stamp:
+            return False
+        ### Requests keep reading the published summary while the copy is updated
+        updated = store.refresh_summary(copy.deepcopy(current), source, stamp = stamp)
+        if updated is None:
+            _panels[c] = {'summary': store.load_summary(source)}
+            return True
+        store.save_summary(updated, store.summary_path(source))
+        _panels[c] = {'summary': updated}
+        return True
+
+    df = messages(c)
+    meta = store.refresh_cache(source)
+    if meta['rows'] == len(df) and meta['epoch'] == df.attrs['epoch']:
+        return False
+    if meta['rows'] < len(df) or meta['epoch'] != df.attrs['epoch']:
+        _panels[c] = {'messages': dh.by_date(store.load_messages(source))}
+        return True
+
+    old = _panels[c]
+    delta = store.add_derived(store.read_columns(store.cache_path(source), len(df)))
+    updated = copy.deepcopy(summary(c))
+    updated.merge(store.MessageSummary(ngram_ns = (), terms = False).add(delta))
+    updated.stamp = meta['stamp']
+    panels = {'summary': updated}
+    ### Fold the new rows into the term matrices too, rather than rebuilding them
+    if 'terms' in old:
+        panels['terms'] = store.extend_terms(old['terms'], df, delta)
+        store.save_pickle((meta['stamp'], panels['terms']), store.terms_path(source))
+    df = pd.concat([df, delta], ignore_index = True)
+    df.attrs = dict(delta.attrs)
+    panels['messages'] = dh.by_date(df)
+    ### The n-gram counts take seconds, so they are redone here, not on a request
+    if 'ngrams' in old:
+        panels['ngrams'] = PANELS['ngrams'](panels.__getitem__, source)
+    if 'terms' in panels:
+        panels['terms'].build = dh.frame_ngrams(panels['messages'])
+        for n in sorted(old['terms'].built):
+            panels['terms'].ngrams(n)
+    _panels[c] = panels
+    return True
+
+def refresh_all():
+    ### Only conversations someone is still looking at are checked
+    evict_idle()
+    for c in list(_panels):
+        try:
+            if refresh(c):
+                log.info('messages refreshed', extra = {'fields': {'conversation': c,
+                                                                   'version': panel('stamp', c)}})
+        except Exception:
+            ### Keep serving the panels already built, the next interval retries
+            log.exception('refresh failed', extra = {'fields': {'conversation': c}})
+
+def refresh_loop():
+    while True:
+        ### Ticks line up on the wall clock, so every worker refreshes at about the same time
+        _refresh_wake.wait(REFRESH_SECONDS - time.time() % REFRESH_SECONDS)
+        _refresh_wake.clear()
+        refresh_all()
+
+def start_refresher():
+    ### Threads don't survive a fork, so each worker starts its own on first use
+    if not REFRESH_SECONDS or _refresher['pid'] == os.getpid():
+        return
+    with _refresh_lock:
+        if _refresher['pid'] != os.getpid():
+            _refresher['pid'] = os.getpid()
+            threading.Thread(target = refresh_loop, daemon = True).start()
 
 #############################
-# Stats #####################
+# Date Range ################
 #############################
-n_txts = len(df)
-wrd_hnt = dh.n_games(df)
-qck_stats = dh.get_stats(df)
+
+# The date picker narrows every panel to a (start, end) range of days. The
+# day, hour, length and stats panels come from the summary's per-day prefix
+# sums (dash_helpers.DayIndex), so any range costs O(days). Words, emojis and
+# n-grams come from the day x term matrices (dash_helpers.TermIndex), summing
+# only the range's rows. Snippets are sampled from the range's messages, one
+# slice of the date-sorted table found by binary search.
+
+RANGE_PANELS = {
+    'count': lambda c, rng: summary(c).days.count(rng),
+    'games': lambda c, rng: summary(c).days.games(rng),
+    'daily': lambda c, rng: summary(c).daily_counts(rng),
+    'hour': lambda c, rng: dh.hour_fig(*summary(c).hourly_counts(rng)),
+    'text_length': lambda c, rng: dh.length_figs(*summary(c).length_tables(rng), PLOT_POINTS),
+    'stats': lambda c, rng: summary(c).stats_frame(rng),
+    'words': lambda c, rng: dh.TableQuery(panel('terms', c).words_table(rng)),
+    'emojis': lambda c, rng: dh.emoji_fig(summary(c).senders,
+                                          [panel('terms', c).sender_emojis(p, rng) for p in summary(c).senders]),
+    'emoji_table': lambda c, rng: dh.TableQuery(ranged('emojis', c, rng)[1]),
+    'ngrams': lambda c, rng: ngram_range(c, rng),
+}
+
+def ngram_range(c, rng):
+    ### The matrices can only drop n-grams holding a stop word, so with the
+    ### messages at hand stop words still re-window over the range's slice
+    def table(n = 1, stops = ()):
+        if stops and not STREAMING:
+            return dh.ngram_engine(ranged('messages', c, rng)).table(n, stops)
+        return panel('terms', c).ngram_table(n, stops, rng = rng)
+    return table
+
+if not STREAMING:
+    RANGE_PANELS['messages'] = lambda c, rng: messages(c).iloc[slice(*dh.message_span(messages(c), *rng))]
+
+def date_range(start, end):
+    ### The picker's dates as a (start, end) pair of day strings, or None for everything
+    if not start and not end:
+        return None
+    return (start[:10] if start else None, end[:10] if end else None)
+
+def in_range(day, rng):
+    return rng is None or ((not rng[0] or day >= rng[0]) and (not rng[1] or day <= rng[1]))
+
+def ranged(name, c, rng):
+    ### Panel `name` of conversation c over the days in `rng`, or its full-history panel
+    if rng is None or name not in RANGE_PANELS:
+        return panel(name, c)
+    return range_panel(panel('stamp', c), c, name, rng)
+
+@lru_cache(maxsize = 32)
+def range_panel(version, c, name, rng):
+    return RANGE_PANELS[name](c, rng)
+
+#############################
+# Callback Cache ############
+#############################
+
+# Figures for inputs that repeat (slider days, N, the default stop words) are
+# memoized per dataset version, see dash_cache.memo_from_env for the bounds
+# and the optional shared file tier. Hit/miss counts are served at /cache-stats.
+
+### Every memoized function takes the conversation first
+memo = dash_cache.memo_from_env(lambda c, *args: panel('stamp', c))
+
+@memo
+def day_figure(c, s, rng):
+    return dh.day_fig(*ranged('daily', c, rng), s, PLOT_POINTS)
+
+@memo
+def day_series(c, s, window, rng):
+    days, _, counts = ranged('daily', c, rng)
+    return [(np.datetime_as_string(x), y) for x, y in dh.day_series(days, counts, s, PLOT_POINTS, window)]
+
+@memo
+def ngram_figure(c, n, stops, rng):
+    return dh.ngram_fig(ranged('ngrams', c, rng)(n, list(stops)))
+
+@app.server.route('/cache-stats')
+def cache_stats():
+    return jsonify(memo.stats())
+
+#############################
+# Metrics ###################
+#############################
+
+# Callback latency and response size, figure builder and panel build times
+# as Prometheus histograms, plus the callback cache's hit/miss counters.
+
+@app.server.route('/metrics')
+def serve_metrics():
+    stats = memo.stats()
+    extra = metrics.counter_lines('claire_cache_hits_total', 'Callback cache hits', 'function',
+                                  {name: s['hits'] for name, s in stats.items()})
+    extra += metrics.counter_lines('claire_cache_misses_total', 'Callback cache misses', 'function',
+                                   {name: s['misses'] for name, s in stats.items()})
+    return Response(metrics.render(extra), mimetype = 'text/plain; version=0.0.4')
 
 #############################
 # Data Tables ###############
 #############################
 
-stats_table = dbc.Table.from_dataframe(qck_stats, striped=True, bordered=True, hover=True, index=False, size = 'sm',
-                                      style = {'font-size' : '20px', 'text-align' : 'center'})
+def stats_table(c = None, rng = None):
+    return dbc.Table.from_dataframe(ranged('stats', c, rng), striped=True, bordered=True, hover=True, index=False, size = 'sm',
+                                    style = {'font-size' : '20px', 'text-align' : 'center'})
+
+# The word and emoji tables hold one row per term, so they are paged, sorted
+# and filtered on the server and only the visible page (and its tooltips) is
+# sent to the browser.
 
 corpus_datatable = dash_table.DataTable(
     id='wordtbl-table',
-    data=word_tbl.to_dict('records'),
-    columns = [{'id': c, 'name': c} for c in word_tbl.columns],
+    columns = [{'id': c, 'name': c} for c in ['person', 'word', 'count']],
     style_table={
         'overflowY': 'scroll',
         'overflowX': 'scroll',
@@ -90,19 +386,20 @@ corpus_datatable = dash_table.DataTable(
         'textOverflow': 'ellipsis',
         'maxWidth': 0
     },
-    tooltip_data=[
-        {column: {'value': str(value), 'type': 'markdown'} for column, value in row.items()} for row in word_tbl.to_dict('records')
-    ],
     tooltip_duration=None,
-    filter_action="native",
-    sort_action="native",
-    page_size=10
+    page_current=0,
+    page_size=10,
+    page_action='custom',
+    filter_action='custom',
+    filter_query='',
+    sort_action='custom',
+    sort_mode='single',
+    sort_by=[]
 )
 
 emots_dt = dash_table.DataTable(
     id='claire-emot-table',
-    data=emots_df.to_dict('records'),
-    columns = [{'id': c, 'name': c} for c in emots_df.columns],
+    columns = [{'id': c, 'name': c} for c in ['emoji', 'n', 'person']],
     style_table={
         'overflowY': 'scroll',
         'overflowX': 'scroll',
@@ -113,33 +410,46 @@ emots_dt = dash_table.DataTable(
         'textOverflow': 'ellipsis',
         'maxWidth': 0
     },
-    tooltip_data=[
-        {column: {'value': str(value), 'type': 'markdown'} for column, value in row.items()} for row in emots_df.to_dict('records')
-    ],
     tooltip_duration=None,
-    filter_action="native",
-    sort_action="native",
-    page_size=10
+    page_current=0,
+    page_size=10,
+    page_action='custom',
+    filter_action='custom',
+    filter_query='',
+    sort_action='custom',
+    sort_mode='single',
+    sort_by=[]
 )
 
 
 
 app.layout = html.Div(children=[
+    dcc.Interval(id='refresh-interval', interval=max(REFRESH_SECONDS, 1) * 1000, disabled=not REFRESH_SECONDS),
+    dcc.Store(id='data-version'),
+
     html.H1(children='Happy 1 Year* of dating!', style = {'text-align' : 'center'}),
     
-    html.H3(children=f'{n_txts:,} Texts! {wrd_hnt:,} word hunt games! and lots of love ❤️', style = {'text-align' : 'center'}),
+    html.H3(id='headline', style = {'text-align' : 'center'}),
 
     html.Div(children='*(2 months and one week)', style = {'text-align' : 'center'}),
     
     html.Br(),
+
+    html.Div([dcc.Dropdown(id='conversation', options=list(CONVERSATIONS), value=FIRST_CONVERSATION, clearable=False)],
+             style = {'width' : '300px', 'margin' : 'auto', 'display' : 'block' if len(CONVERSATIONS) > 1 else 'none'}),
+
+    html.Div([dcc.DatePickerRange(id='date-range', clearable=True, display_format='YYYY-MM-DD',
+                                  start_date_placeholder_text='First day', end_date_placeholder_text='Last day')],
+             style = {'text-align' : 'center'}),
     
     html.Br(),
     
     html.Div([dbc.Col([html.P(id = 'random-text', style={'vertical-align' : 'center', 'display' : 'inline-block', "margin-left": "50px"})]),
               dcc.Interval(id='interval-component1', interval=20000, n_intervals=0),
+              dcc.Store(id='snippets'),
               
               dbc.Col([html.H3('Some Quick Stats', style = {'text-align' : 'center'}),
-                      html.Div([stats_table])]),
+                      dcc.Loading(html.Div(id='stats-table'))]),
               
               dbc.Col([html.H3('How do we look?', style = {'text-align' : 'center'}),
                        html.Div([html.Img(id='random-pic')],  style = {'display': 'block', 'marginLeft': 'auto' ,
@@ -157,20 +467,20 @@ app.layout = html.Div(children=[
                  html.P("Choose number of smoothing days: "),
                  daq.Slider(min=1, max=365, step=1, value=1, id='smoothing-param', size = 150),
                  html.P(id='smooth-text'),
-                 dcc.Graph(figure = day_ts_fig,id="txt-by-day", style = {'display' : 'inline-block', "margin-left": "15px"}),]),
+                 dcc.Graph(id="txt-by-day", style = {'display' : 'inline-block', "margin-left": "15px"}),]),
         dbc.Col([html.H3('Our Total Words per Day'),
-                 dcc.Graph(figure = wd_dist, id="wd-dist-fig", style = {'display' : 'inline-block'})
+                 dcc.Loading(dcc.Graph(id="wd-dist-fig", style = {'display' : 'inline-block'}))
                 ])
             ], style = {'display' : 'flex', "margin-left": "50px", "margin-left": "50px"}),
     
     html.Br(),
     
     html.Div([dbc.Col([html.H3('Our Total Texts by Hour'),
-                       dcc.Graph(figure = hour_ts_fig, id="txt-by-hour", style = {'display' : 'inline-block'})
+                       dcc.Loading(dcc.Graph(id="txt-by-hour", style = {'display' : 'inline-block'}))
                       ]),
               
               dbc.Col([html.H3('Number of Words per Text'),
-                       dcc.Graph(figure = txt_dist, id="txt-len-dist", style = {'display' : 'inline-block'})
+                       dcc.Loading(dcc.Graph(id="txt-len-dist", style = {'display' : 'inline-block'}))
                       ])
              ], style = {'display' : 'flex', "margin-left": "50px", "margin-left": "50px"}),
     
@@ -182,70 +492,286 @@ app.layout = html.Div(children=[
                           dcc.Input(id='ngram', type='number', value = 1, min=1, max=5, step=1, debounce = True)
                          ], style = {'display' : 'inline-block'}),
                 html.Div([html.P("Choose Stop Words:"),
-                        dcc.Input(id='stops', value = 'word hunt reversi 20 questions', debounce = True, placeholder = "seperate with spaces")
+                        dcc.Input(id='stops', value = DEFAULT_STOPS, debounce = True, placeholder = "seperate with spaces")
                          ], style = {'display' : 'inline-block', "margin-left": "15px"}),
-                html.Div([dcc.Graph(figure = ngrams_fig, id="ngrams-fig", style = {'display' : 'inline-block'}),
-                        ])])])
+                html.Div([dcc.Graph(id="ngrams-fig", style = {'display' : 'inline-block'}),
+                        ]),
+                html.Div([corpus_datatable])])])
                     ]),
         
             dbc.Col([html.H3('Our Favorite Emojis'),
-                     dcc.Graph(figure = emots_fig, id="emot-fig", style = {'display' : 'inline-block'})
+                     dcc.Loading(dcc.Graph(id="emot-fig", style = {'display' : 'inline-block'})),
+                     html.Div([emots_dt])
                     ])
                 ], style = {'display' : 'flex', "margin-left": "50px", "margin-left": "50px"})
 ])
 
 
+LAZY_FIGURES = {
+    'txt-by-hour': lambda c, rng: ranged('hour', c, rng),
+    'txt-len-dist': lambda c, rng: ranged('text_length', c, rng)[0],
+    'wd-dist-fig': lambda c, rng: ranged('text_length', c, rng)[1],
+    'emot-fig': lambda c, rng: ranged('emojis', c, rng)[0],
+}
+
+### Every panel callback also takes the picked range
+RANGE_INPUTS = [Input('date-range', 'start_date'), Input('date-range', 'end_date')]
+
+# The data version is [conversation, stamp], so picking another conversation
+# and a refresh of the current one both redraw every panel, and callbacks
+# read the conversation from it. Polls land on any worker, and one that
+# hasn't refreshed yet would send the page back a version; a stamp this
+# process never served is newer, so it wakes the refresher and the page
+# keeps what it has.
+
+_served = {}
+
 @app.callback(
-    Output('random-text', 'children'),
-    Input('interval-component1', 'n_intervals')
+    Output('data-version', 'data'),
+    Input('refresh-interval', 'n_intervals'),
+    Input('conversation', 'value'),
+    State('data-version', 'data')
 )
-def sample_text(n):
-    randi = randint(0, len(df) - 1)
-    
-    text = df.iloc[randi:(randi+10), : ]
-    date = text.Day.iloc[0]
+def check_version(n, c, seen):
+    start_refresher()
+    c = used(c if c in CONVERSATIONS else FIRST_CONVERSATION)
+    stamp = panel('stamp', c)
+    evict_idle()
+    served = _served.setdefault(c, deque(maxlen = 256))
+    if stamp not in served:
+        served.append(stamp)
+    if seen and seen[0] == c and seen[1] != stamp and seen[1] not in served:
+        _refresh_wake.set()
+        return no_update
+    version = [c, stamp]
+    return no_update if version == seen else version
+
+def picked(version):
+    return used(version[0] if version else FIRST_CONVERSATION)
+
+@app.callback(
+    Output('date-range', 'min_date_allowed'),
+    Output('date-range', 'max_date_allowed'),
+    Input('data-version', 'data')
+)
+def date_bounds(version):
+    days = summary(picked(version)).days.days
+    if not len(days):
+        return None, None
+    return str(days[0].date()), str(days[-1].date())
+
+def lazy_figure(build):
+    return lambda version, start, end: build(picked(version), date_range(start, end))
+
+for graph_id, build in LAZY_FIGURES.items():
+    app.callback(Output(graph_id, 'figure'), Input('data-version', 'data'), *RANGE_INPUTS)(lazy_figure(build))
+
+PAGED_TABLES = {
+    'wordtbl-table': lambda c, rng: ranged('words', c, rng),
+    'claire-emot-table': lambda c, rng: ranged('emoji_table', c, rng),
+}
+
+def paged_table(query):
+    def update(page_current, page_size, sort_by, filter_query, version, start, end):
+        rows, page_count = query(picked(version), date_range(start, end)).page(page_current, page_size, sort_by, filter_query)
+        tooltips = [{column: {'value': str(value), 'type': 'markdown'} for column, value in row.items()} for row in rows]
+        return rows, tooltips, page_count
+    return update
+
+for table_id, query in PAGED_TABLES.items():
+    app.callback(
+        Output(table_id, 'data'),
+        Output(table_id, 'tooltip_data'),
+        Output(table_id, 'page_count'),
+        Input(table_id, 'page_current'),
+        Input(table_id, 'page_size'),
+        Input(table_id, 'sort_by'),
+        Input(table_id, 'filter_query'),
+        Input('data-version', 'data'),
+        *RANGE_INPUTS
+    )(paged_table(query))
+
+@app.callback(
+    Output('headline', 'children'),
+    Input('data-version', 'data'),
+    *RANGE_INPUTS
+)
+def show_headline(version, start, end):
+    c, rng = picked(version), date_range(start, end)
+    return f'{ranged("count", c, rng):,} Texts! {ranged("games", c, rng):,} word hunt games! and lots of love ❤️'
+
+@app.callback(
+    Output('stats-table', 'children'),
+    Input('data-version', 'data'),
+    *RANGE_INPUTS
+)
+def show_stats(version, start, end):
+    return stats_table(picked(version), date_range(start, end))
+
+# By default the browser gets a batch of random conversation windows once per
+# page load and rotates through them itself; CLAIRE_CLIENTSIDE_SAMPLER=0 goes
+# back to asking the server every tick.
+
+CLIENTSIDE_SAMPLER = os.environ.get('CLAIRE_CLIENTSIDE_SAMPLER', '1') != '0'
+
+def snippet_children(date, rows):
     final = [html.H3(f'What did we say on {date}?', style = {'text-align' : 'center'}), html.Br()]
-    
-    for i in text.index:
-        txt = text.loc[i, 'Text']
-        sender = text.loc[i, 'Type']
-        final += [html.Strong(f"{sender}: "), html.Span(f"{txt}"), html.Br()]
-        
+    for sender, txt in rows:
+        final += [html.Strong(f"{sender}: "), html.Span(txt), html.Br()]
     return final
 
+if CLIENTSIDE_SAMPLER:
+    @app.callback(
+        Output('snippets', 'data'),
+        Input('data-version', 'data'),
+        *RANGE_INPUTS
+    )
+    def send_snippets(version, start, end):
+        return snippets(picked(version), date_range(start, end))
+
+    app.clientside_callback(
+        """
+        function(n, data) {
+            if (!data || !data.windows.length) {
+                return window.dash_clientside.no_update;
+            }
+            var w = data.windows[Math.floor(Math.random() * data.windows.length)];
+            var el = function(type, props) {
+                return {type: type, namespace: 'dash_html_components', props: props};
+            };
+            var final = [el('H3', {children: 'What did we say on ' + w.day + '?', style: {'text-align': 'center'}}), el('Br', {})];
+            w.messages.forEach(function(m) {
+                final.push(el('Strong', {children: data.senders[m[0]] + ': '}), el('Span', {children: m[1]}), el('Br', {}));
+            });
+            return final;
+        }
+        """,
+        Output('random-text', 'children'),
+        Input('interval-component1', 'n_intervals'),
+        Input('snippets', 'data')
+    )
+else:
+    @app.callback(
+        Output('random-text', 'children'),
+        Input('interval-component1', 'n_intervals'),
+        State('data-version', 'data'),
+        State('date-range', 'start_date'),
+        State('date-range', 'end_date')
+    )
+    def sample_text(n, version, start, end):
+        c, rng = picked(version), date_range(start, end)
+        if STREAMING:
+            data = snippets(c, rng)
+            if not data['windows']:
+                return no_update
+            w = data['windows'][randint(0, len(data['windows']) - 1)]
+            return snippet_children(w['day'], [(data['senders'][c], txt) for c, txt in w['messages']])
+        df = ranged('messages', c, rng)
+        if not len(df):
+            return no_update
+        return snippet_children(*dh.snippet(df, randint(0, len(df) - 1)))
+
 @app.callback(
     Output('random-pic', 'src'),
     Input('interval-component1', 'n_intervals'))
 def update_image_src(n):
-    # print the image_path to confirm the selection is as expected
     randi = randint(0, len(pictures) - 1)
     
-    image_path = f"assets/{pictures[randi]}"
-    print('current image_path = {}'.format(image_path))
-    encoded_image = base64.b64encode(open(image_path, 'rb').read())
-    return 'data:image/png;base64,{}'.format(encoded_image.decode())
+    image_path = f"/pics/{quote(pictures[randi])}"
+    metrics.debug('image', path = image_path)
+    return image_path
+
 
+def day_window(relayout):
+    ### The dates the day graph is zoomed to, or None when it shows everything
+    relayout = relayout or {}
+    if 'xaxis.range[0]' in relayout:
+        return str(relayout['xaxis.range[0]'])[:10], str(relayout['xaxis.range[1]'])[:10]
+    if 'xaxis.range' in relayout:
+        return tuple(str(r)[:10] for r in relayout['xaxis.range'])
+    return None
 
 @app.callback(
     Output('txt-by-day', 'figure'),
     Output('smooth-text', 'children'),
-    Input('smoothing-param', 'value')
+    Input('smoothing-param', 'value'),
+    Input('data-version', 'data'),
+    Input('txt-by-day', 'relayoutData'),
+    *RANGE_INPUTS
 )
-def adjust_smoothing(s):
-    fig = dh.plot_by_day(df, s)
+def adjust_smoothing(s, version, relayout, start, end):
     s_text = f'You have chosen: {s} days'
+    c, rng = picked(version), date_range(start, end)
+    if ctx.triggered_id not in ('smoothing-param', 'txt-by-day'):
+        return day_figure(c, s, rng), s_text
+
+    window = day_window(relayout)
+    if ctx.triggered_id == 'txt-by-day' and window is None and not (relayout or {}).get('xaxis.autorange'):
+        return no_update, no_update
+
+    ### Slider moves and zooms only swap the points of the lines already on the
+    ### page, at full resolution once the zoomed range fits in PLOT_POINTS
+    fig = Patch()
+    for i, (x, y) in enumerate(day_series(c, s, window, rng)):
+        fig['data'][i]['x'] = x
+        fig['data'][i]['y'] = y
     return fig, s_text
 
 @app.callback(
     Output('ngrams-fig', 'figure'),
     Input('ngram', 'value'),
-    Input('stops', 'value')
+    Input('stops', 'value'),
+    Input('data-version', 'data'),
+    *RANGE_INPUTS
 )
-def choose_ngram(n, stops):
-    print(stops)
-    stop_words = stops.split()
-    fig = dh.ngram_cnt(df, n, stop_words)
+def choose_ngram(n, stops, version, start, end):
+    metrics.debug('ngrams', n = n, stops = stops, start = start, end = end)
+    stop_words = tuple(stops.split())
+    fig = ngram_figure(picked(version), n, stop_words, date_range(start, end))
     return fig
 
-# app.run_server(debug=True)
-app.run_server(host='0.0.0.0', port=8050)
+##########################
+# Serving ################
+##########################
+
+# Production entry point for a pre-forking WSGI server (see gunicorn.conf.py).
+# With preload_app the parent imports this module and calls create_server(),
+# which loads the messages and builds every panel before the workers fork, so
+# they all share one read-only copy instead of each downloading and parsing it.
+# The panels that only read the messages go through dash_precompute first,
+# one after another here or, where it pays off, side by side on a process
+# pool while this process loads the table it keeps; the rest are cheap and
+# follow here.
+
+def preload(names = PANELS, c = None):
+    c = c or FIRST_CONVERSATION
+    panels = _panels.setdefault(c, {})
+
+    def read_messages(path):
+        ### The columns the workers read, so the table matches what they built from
+        panels['messages'] = dh.by_date(store.add_derived(store.read_columns(path)))
+
+    built = dash_precompute.precompute(CONVERSATIONS[c], names, get = lambda name: panel(name, c),
+                                       meanwhile = read_messages)
+    if 'terms' in built and built['terms'].build is None:
+        ### Sent back from a worker; the n-gram tables are made from this process's table
+        built['terms'].build = dh.frame_ngrams(panels['messages'])
+    for name, value in built.items():
+        panels.setdefault(name, value)
+    for name in names:
+        panel(name, c)
+    ### Move everything built so far out of the collector's reach so a worker's
+    ### GC passes don't write to, and so un-share, the inherited pages
+    gc.collect()
+    gc.freeze()
+
+def create_server(preload_panels = True):
+    if preload_panels:
+        preload()
+    ### Usually fetched by now, alongside the messages
+    valid_username_password_pairs()
+    return app.server
+
+if __name__ == '__main__':
+    # app.run_server(debug=True)
+    app.run_server(host='0.0.0.0', port=8050)
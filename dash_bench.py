@@ -0,0 +1,381 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import platform
+import re
+import time
+import tracemalloc
+from collections import Counter
+import numpy as np
+import pandas as pd
+import dash_helpers as dh
+from dash_store import add_derived
+
+##########################
+# Synthetic Corpus #######
+##########################
+
+WORDS = ['i', 'love', 'you', 'so', 'much', 'lol', 'haha', 'ok', 'yes', 'no', 'what', 'dinner',
+         'tonight?', 'miss', 'you!', 'good', 'morning', 'night', 'babe', 'see', 'soon', 'omg',
+         'Word', 'Hunt', 'the', 'a', 'to', 'and', 'is', 'that', 'really', 'cute', 'wait']
+EMOJIS = ['😂', '❤️', '🥰', '😭', '👍', '🙈', '😘', '🟩', '🟨']
+### What the Word Hunt game leaves in the export
+GAMES = ['Word Hunt', 'Let’s play Word Hunt!', 'I scored 2,400 in Word Hunt', 'word hunt?']
+
+def synthetic_messages(n, seed = 0, start = '2021-08-01', days = 400):
+    ### Raw export schema: string dates (a few missing), Incoming/Outgoing, free
+    ### text with quotes and NaNs
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp(start).value
+    stamps = np.sort(rng.integers(start, start + days * 86400 * 10**9, n))
+    dates = pd.to_datetime(stamps).strftime(dh.DATE_FORMAT).to_numpy(dtype = object)
+    dates[rng.random(n) < 0.002] = np.nan
+
+    vocab = np.array(WORDS + EMOJIS, dtype = object)
+    lengths = rng.geometric(0.2, n)
+    tokens = vocab[rng.integers(0, len(vocab), lengths.sum())]
+    texts = np.array([' '.join(t) for t in np.split(tokens, np.cumsum(lengths)[:-1])], dtype = object)
+
+    quoted = rng.random(n) < 0.02
+    texts[quoted] = ['Loved “' + t + '”' for t in texts[quoted]]
+    games = rng.random(n) < 0.005
+    texts[games] = np.array(GAMES, dtype = object)[rng.integers(0, len(GAMES), games.sum())]
+    texts[rng.random(n) < 0.01] = np.nan
+
+    return pd.DataFrame({
+        'Message Date': dates,
+        'Type': np.where(rng.random(n) < 0.5, 'Incoming', 'Outgoing'),
+        'Text': texts,
+    })
+
+def cleaned_messages(n, seed = 0):
+    return add_derived(dh.clean_messages(synthetic_messages(n, seed)))
+
+##########################
+# Timing #################
+##########################
+
+def timed(f, *args, repeat = 1):
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        out = f(*args)
+        best = min(best, time.perf_counter() - t)
+    return best, out
+
+##########################
+# Cleaning ###############
+##########################
+
+def legacy_clean(df):
+    df['Message Date'] = df['Message Date'].apply(pd.to_datetime)
+    df['Type'] = df['Type'].apply(lambda x: 'Claire' if x == 'Incoming' else 'Gabe')
+    df.Text = df.Text.apply(lambda x: re.sub('“.*?”', '', x) if not pd.isnull(x) else x)
+    return df
+
+def bench_clean(rows, legacy_rows = None):
+    ### The per-row legacy parser is slow enough that it is sampled on fewer rows
+    raw = synthetic_messages(rows)
+    legacy_rows = min(legacy_rows or rows, rows)
+
+    t_new, new = timed(dh.clean_messages, raw.copy())
+    t_old, old = timed(legacy_clean, raw.iloc[:legacy_rows].copy())
+    assert old.astype({'Type': object}).equals(new.iloc[:legacy_rows].astype({'Type': object}))
+
+    print(f'legacy clean   : {legacy_rows / t_old:>14,.0f} rows/s ({legacy_rows:,} rows in {t_old:.2f}s)')
+    print(f'clean_messages : {rows / t_new:>14,.0f} rows/s ({rows:,} rows in {t_new:.2f}s)')
+
+##########################
+# Emojis #################
+##########################
+
+def legacy_emoji_counts(df, person, stops):
+    corpus = df.loc[df.Type == person, 'Text'].str.cat(sep=' ')
+    corpus = [i.lower() for i in corpus.split()]
+    emojies = dh.split_count(' '.join(corpus))
+    return Counter(' '.join(e for e in emojies if e not in stops).split())
+
+def fast_emoji_counts(df, stops):
+    cnts = dh.emoji_counts(df, stops)
+    return {p: Counter(dict(dh.sender_emojis(cnts, p)[['emoji', 'n']].values)) for p in df.Type.unique()}
+
+def bench_emoji(rows):
+    df = cleaned_messages(rows)
+    stops = ['🟨', '🟩', '⬛', '', '  ']
+
+    t_old, old = timed(lambda: {p: legacy_emoji_counts(df, p, stops) for p in df.Type.unique()})
+    dh.emoji_chars()
+    t_new, new = timed(fast_emoji_counts, df, stops)
+    assert old == new
+
+    print(f'split_count    : {t_old:.2f}s')
+    print(f'extract_emojis : {t_new:.2f}s ({t_old / t_new:.1f}x, identical counts)')
+
+##########################
+# Aggregations ###########
+##########################
+
+AGGREGATIONS = [
+    ('token index', dh.token_index),
+    ('daily counts', dh.daily_counts),
+    ('plot_by_day', dh.plot_by_day),
+    ('plot_by_hour', dh.plot_by_hour),
+    ('text_length', dh.text_length),
+    ('get_stats', dh.get_stats),
+]
+
+def bench_aggregations(sizes):
+    ### Run in order on a fresh frame so later steps reuse the cached index and counts, as the app does
+    for rows in sizes:
+        df = cleaned_messages(rows)
+        print(f'{rows:,} messages, {dash_precompute.usable_cpus()} usable CPUs')
+        for name, f in AGGREGATIONS:
+            t, _ = timed(f, df)
+            print(f'  {name:<14}: {t * 1000:>10.1f} ms')
+
+##########################
+# Startup ################
+##########################
+
+STARTUP_PROBE = """
+import json, time
+t = time.perf_counter()
+import dash_app
+ready = time.perf_counter() - t
+dash_app.messages()
+print(json.dumps({'ready': ready, 'loaded': time.perf_counter() - t}))
+"""
+
+def bench_startup(rows, runs = 2):
+    ### Import the app in a fresh interpreter against a synthetic export; the
+    ### first run ingests into an empty cache, later runs read the columns back
+    with tempfile.TemporaryDirectory() as tmp:
+        csv = os.path.join(tmp, 'messages.csv')
+        keys = os.path.join(tmp, 'pass_keys.json')
+        synthetic_messages(rows).to_csv(csv, index = False)
+        with open(keys, 'w') as f:
+            json.dump({'bench': 'bench'}, f)
+
+        env = dict(os.environ, CLAIRE_MESSAGES = csv, CLAIRE_PASS_KEYS = keys,
+                   CLAIRE_CACHE_DIR = os.path.join(tmp, 'cache'))
+        here = os.path.dirname(os.path.abspath(__file__))
+        for run in range(runs):
+            out = subprocess.run([sys.executable, '-c', STARTUP_PROBE], env = env, cwd = here,
+                                 capture_output = True, text = True, check = True)
+            res = json.loads(out.stdout.strip().splitlines()[-1])
+            label = 'cold cache' if run == 0 else 'warm cache'
+            print(f'{label}: server ready after {res["ready"]:.2f}s, messages loaded after {res["loaded"]:.2f}s ({rows:,} rows)')
+
+##########################
+# Precompute #############
+##########################
+
+def bench_precompute(rows, workers):
+    ### Every dash_precompute task, serially and on pools of each size, against a
+    ### synthetic export whose column cache is written before the first run
+    import dash_store as store
+    import dash_precompute
+
+    with tempfile.TemporaryDirectory() as tmp:
+        csv = os.path.join(tmp, 'messages.csv')
+        synthetic_messages(rows).to_csv(csv, index = False)
+        ### Set in the environment too, so spawned workers save the terms there
+        store.CACHE_DIR = os.environ['CLAIRE_CACHE_DIR'] = os.path.join(tmp, 'cache')
+        source = store.LocalSource(csv)
+        store.refresh_cache(source)
+        print(f'{rows:,} messages, {dash_precompute.usable_cpus()} usable CPUs')
+        for n in [0] + list(workers):
+            ### Or the later runs would just read back the first one's term matrices
+            if os.path.exists(store.terms_path(source)):
+                os.remove(store.terms_path(source))
+            seconds = {}
+            t = time.perf_counter()
+            dash_precompute.precompute(source, workers = n, timings = seconds)
+            wall = time.perf_counter() - t
+            label = 'serial' if not n else f'{n} workers'
+            print(f'  {label:<10}: {wall:>7.2f}s wall')
+            for name, s in sorted(seconds.items(), key = lambda kv: -kv[1]):
+                print(f'    {name:<11}: {s * 1000:>9.1f} ms')
+
+##########################
+# Suite ##################
+##########################
+
+# Every helper the dashboard calls, timed on its own fresh copy of the frame
+# so no run reuses another's cached index or counts. Wall time and peak
+# traced memory come from separate runs since tracing slows allocations.
+# Results are appended as JSON lines tagged with the commit, for `compare`.
+
+SUITE = [
+    ('plot_by_day', dh.plot_by_day),
+    ('plot_by_hour', dh.plot_by_hour),
+    ('words_table', dh.words_table),
+    ('text_length', dh.text_length),
+    ('n_games', dh.n_games),
+    ('get_stats', dh.get_stats),
+    ('emoji_cnt', dh.emoji_cnt),
+    ('ngram_cnt', lambda df: dh.ngram_cnt(df, 2, ['word', 'hunt'])),
+    ('term_index', dh.TermIndex.from_frame),
+]
+RESULTS = os.path.join('.bench', 'results.jsonl')
+
+def peak_memory(f, *args):
+    tracemalloc.start()
+    try:
+        f(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def git_revision():
+    here = os.path.dirname(os.path.abspath(__file__))
+    out = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd = here, capture_output = True, text = True)
+    return out.stdout.strip() or 'unknown'
+
+def run_suite(sizes, names = None, repeat = 1, seed = 0):
+    suite = [(name, f) for name, f in SUITE if not names or name in names]
+    ### Pay for lazy imports and one-off tables (emoji set, plotly) before timing
+    for name, f in suite:
+        f(cleaned_messages(200, seed))
+    rows = []
+    for n in sizes:
+        df = cleaned_messages(n, seed)
+        print(f'{n:,} messages')
+        for name, f in suite:
+            t = min(timed(f, df.copy())[0] for _ in range(repeat))
+            peak = peak_memory(f, df.copy())
+            print(f'  {name:<13}: {t * 1000:>10.1f} ms {peak / 2**20:>10.1f} MiB')
+            rows.append({'bench': name, 'rows': n, 'seconds': t, 'peak_bytes': peak})
+    return rows
+
+def save_results(rows, path = RESULTS):
+    run = {'revision': git_revision(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'python': platform.python_version(), 'pandas': pd.__version__, 'numpy': np.__version__}
+    os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+    with open(path, 'a') as f:
+        for row in rows:
+            f.write(json.dumps(dict(run, **row)) + '\n')
+    print(f'saved {len(rows)} results for {run["revision"]} to {path}')
+
+def compare_results(path = RESULTS, base = None, head = None):
+    ### Latest result per (revision, bench, rows); base/head default to the last two revisions saved
+    res = pd.read_json(path, lines = True)
+    revisions = list(dict.fromkeys(res.revision[::-1]))
+    head = head or revisions[0]
+    base = base or (revisions[1] if len(revisions) > 1 else head)
+    latest = res.groupby(['revision', 'bench', 'rows'], sort = False).last()
+
+    table = latest.loc[base][['seconds', 'peak_bytes']].join(latest.loc[head][['seconds', 'peak_bytes']],
+                                                             lsuffix = '_base', rsuffix = '_head', how = 'inner')
+    print(f'{base} -> {head}')
+    for (name, n), r in table.iterrows():
+        print(f'  {name:<13} {n:>11,}: {r.seconds_base * 1000:>9.1f} -> {r.seconds_head * 1000:>9.1f} ms '
+              f'({r.seconds_base / r.seconds_head:>5.2f}x)  '
+              f'{r.peak_bytes_base / 2**20:>8.1f} -> {r.peak_bytes_head / 2**20:>8.1f} MiB')
+
+##########################
+# Import Time ############
+##########################
+
+# An import-time budget for the app. Modules in DEFERRED_IMPORTS are only
+# needed once a figure is drawn, an emoji counted or S3 touched, so any of
+# them showing up while dash_app imports means a heavy import crept back to
+# module level. The command exits non-zero when either check fails.
+
+DEFERRED_IMPORTS = ['plotly.express', 'plotly.figure_factory', 'emoji', 'regex', 'boto3', 'PIL.Image', 'nltk']
+IMPORT_BUDGET_MS = float(os.environ.get('CLAIRE_IMPORT_BUDGET_MS', '2000'))
+IMPORT_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+def import_times(module, env):
+    ### (cumulative us, depth, name) for every import -X importtime reports
+    here = os.path.dirname(os.path.abspath(__file__))
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], env = env, cwd = here,
+                         capture_output = True, text = True)
+    return [(int(m.group(2)), len(m.group(3)) // 2, m.group(4))
+            for m in map(IMPORT_LINE.search, out.stderr.splitlines()) if m]
+
+def check_import_time(budget_ms = IMPORT_BUDGET_MS, runs = 3, top = 10):
+    with tempfile.TemporaryDirectory() as tmp:
+        ### Nothing to load, so the app's background loader can't import anything mid-measurement
+        env = dict(os.environ, CLAIRE_MESSAGES = os.path.join(tmp, 'missing.csv'),
+                   CLAIRE_PASS_KEYS = os.path.join(tmp, 'missing.json'),
+                   CLAIRE_CACHE_DIR = os.path.join(tmp, 'cache'))
+        runs = [import_times('dash_app', env) for _ in range(runs)]
+
+    times = min(runs, key = lambda r: max((t for t, depth, name in r if name == 'dash_app'), default = float('inf')))
+    total = max((t for t, depth, name in times if name == 'dash_app'), default = 0) / 1000
+    eager = sorted({name for _, _, name in times for lazy in DEFERRED_IMPORTS
+                    if name == lazy or name.startswith(lazy + '.')})
+
+    print(f'import dash_app: {total:.0f} ms (budget {budget_ms:.0f} ms, best of {len(runs)})')
+    for t, _, name in sorted((r for r in times if r[1] == 1), reverse = True)[:top]:
+        print(f'  {name:<28}: {t / 1000:>8.1f} ms')
+
+    ok = total <= budget_ms and not eager
+    if eager:
+        print(f'imported at startup but should be deferred: {", ".join(eager)}')
+    if total > budget_ms:
+        print(f'import time over budget by {total - budget_ms:.0f} ms')
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmarks for the dashboard helpers')
+    sub = parser.add_subparsers(dest = 'bench', required = True)
+
+    p = sub.add_parser('clean', help = 'legacy per-row cleaning vs clean_messages')
+    p.add_argument('--rows', type = int, default = 1_000_000)
+    p.add_argument('--legacy-rows', type = int, default = 100_000)
+
+    p = sub.add_parser('emoji', help = 'split_count over joined corpora vs extract_emojis')
+    p.add_argument('--rows', type = int, default = 200_000)
+
+    p = sub.add_parser('aggregate', help = 'time the day/hour/length/stats aggregations')
+    p.add_argument('--sizes', type = int, nargs = '+', default = [100_000, 1_000_000, 10_000_000])
+
+    p = sub.add_parser('startup', help = 'time importing dash_app against a synthetic export')
+    p.add_argument('--rows', type = int, default = 1_000_000)
+    p.add_argument('--runs', type = int, default = 2)
+
+    p = sub.add_parser('precompute', help = 'time the startup panels serially and on process pools')
+    p.add_argument('--rows', type = int, default = 1_000_000)
+    p.add_argument('--workers', type = int, nargs = '+', default = [2, 4])
+
+    p = sub.add_parser('suite', help = 'time and trace memory of every dashboard helper, saving the results')
+    p.add_argument('--sizes', type = int, nargs = '+', default = [10_000, 100_000, 1_000_000])
+    p.add_argument('--only', nargs = '+', choices = [name for name, _ in SUITE])
+    p.add_argument('--repeat', type = int, default = 1)
+    p.add_argument('--out', default = RESULTS)
+    p.add_argument('--no-save', action = 'store_true')
+
+    p = sub.add_parser('compare', help = 'compare saved suite results between two revisions')
+    p.add_argument('--results', default = RESULTS)
+    p.add_argument('--base')
+    p.add_argument('--head')
+
+    p = sub.add_parser('importtime', help = 'fail if importing dash_app is over budget or loads deferred modules')
+    p.add_argument('--budget', type = float, default = IMPORT_BUDGET_MS, help = 'milliseconds')
+    p.add_argument('--runs', type = int, default = 3)
+
+    args = parser.parse_args()
+    if args.bench == 'clean':
+        bench_clean(args.rows, args.legacy_rows)
+    elif args.bench == 'emoji':
+        bench_emoji(args.rows)
+    elif args.bench == 'aggregate':
+        bench_aggregations(args.sizes)
+    elif args.bench == 'startup':
+        bench_startup(args.rows, args.runs)
+    elif args.bench == 'precompute':
+        bench_precompute(args.rows, args.workers)
+    elif args.bench == 'suite':
+        rows = run_suite(args.sizes, args.only, args.repeat)
+        if not args.no_save:
+            save_results(rows, args.out)
+    elif args.bench == 'compare':
+        compare_results(args.results, args.base, args.head)
+    elif args.bench == 'importtime':
+        sys.exit(0 if check_import_time(args.budget, args.runs) else 1)
@@ -0,0 +1,183 @@
+import os
+import time
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict, defaultdict
+from functools import wraps
+
+##########################
+# Backends ###############
+##########################
+
+# Both backends share get(key) -> (found, value) and set(key, value). Keys are
+# hashable tuples; entries older than `ttl` seconds are treated as missing.
+
+class LRUCache:
+    def __init__(self, maxsize = 256, ttl = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                return False, None
+            stored, value = self._data[key]
+            if self.ttl is not None and time.monotonic() - stored > self.ttl:
+                del self._data[key]
+                return False, None
+            self._data.move_to_end(key)
+            return True, value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last = False)
+
+    def __len__(self):
+        return len(self._data)
+
+    ### Picklable (e.g. held by a panel a precompute worker sends back), minus the lock
+    def __getstate__(self):
+        with self._lock:
+            return {k: v for k, v in self.__dict__.items() if k != '_lock'}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class FileCache:
+    # Pickled entries in a directory, so every worker on a host can reuse a
+    # result any one of them computed. Writes go through a temp file and an
+    # atomic rename so readers never see a partial pickle. Every `prune_every`
+    # writes, expired entries are deleted and then the least recently used
+    # ones past `maxsize`, which also clears out keys of old data versions.
+
+    def __init__(self, path, maxsize = 2048, ttl = None, prune_every = 32):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.prune_every = prune_every
+        self._writes = 0
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok = True)
+
+    def _file(self, key):
+        return os.path.join(self.path, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.pkl')
+
+    def get(self, key):
+        f = self._file(key)
+        try:
+            if self.ttl is not None and time.time() - os.path.getmtime(f) > self.ttl:
+                os.remove(f)
+                return False, None
+            with open(f, 'rb') as fh:
+                value = pickle.load(fh)
+            ### Reads count as use, so pruning drops the least recently used
+            os.utime(f)
+            return True, value
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+
+    def set(self, key, value):
+        f = self._file(key)
+        tmp = f'{f}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wb') as fh:
+            pickle.dump(value, fh, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, f)
+        with self._lock:
+            self._writes += 1
+            due = self._writes % self.prune_every == 0
+        if due:
+            self.prune()
+
+    def prune(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.pkl'):
+                continue
+            f = os.path.join(self.path, name)
+            try:
+                entries.append((os.path.getmtime(f), f))
+            except OSError:
+                continue
+        entries.sort(reverse = True)
+        now = time.time()
+        for i, (mtime, f) in enumerate(entries):
+            if i >= self.maxsize or (self.ttl is not None and now - mtime > self.ttl):
+                try:
+                    os.remove(f)
+                except OSError:
+                    pass
+
+    def __len__(self):
+        return sum(name.endswith('.pkl') for name in os.listdir(self.path))
+
+##########################
+# Memoizer ###############
+##########################
+
+class Memo:
+    # Looks results up in each backend in turn (fast in-process LRU first),
+    # filling the earlier ones on a later hit. Every key carries the version
+    # of the data the call reads, version(*args, **kwargs), so a data refresh
+    # never serves a stale figure.
+
+    def __init__(self, backends, version = lambda *args, **kwargs: None):
+        self.backends = backends
+        self.version = version
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        ### Callbacks run on several threads per worker
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        for i, backend in enumerate(self.backends):
+            found, value = backend.get(key)
+            if found:
+                for earlier in self.backends[:i]:
+                    earlier.set(key, value)
+                return True, value
+        return False, None
+
+    def __call__(self, f):
+        name = f'{f.__module__}.{f.__qualname__}'
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            key = (name, self.version(*args, **kwargs), args, tuple(sorted(kwargs.items())))
+            found, value = self.lookup(key)
+            if found:
+                with self._lock:
+                    self.hits[name] += 1
+                return value
+
+            with self._lock:
+                self.misses[name] += 1
+            value = f(*args, **kwargs)
+            for backend in self.backends:
+                backend.set(key, value)
+            return value
+
+        return wrapper
+
+    def stats(self):
+        with self._lock:
+            return {name: {'hits': self.hits[name], 'misses': self.misses[name]}
+                    for name in sorted(set(self.hits) | set(self.misses))}
+
+def memo_from_env(version = lambda *args, **kwargs: None):
+    ### CLAIRE_CALLBACK_CACHE_SIZE / _TTL bound the LRU; CLAIRE_CALLBACK_CACHE_DIR adds a shared
+    ### file tier holding at most CLAIRE_CALLBACK_CACHE_FILES entries under the same TTL
+    ttl = os.environ.get('CLAIRE_CALLBACK_CACHE_TTL')
+    ttl = float(ttl) if ttl else None
+    backends = [LRUCache(int(os.environ.get('CLAIRE_CALLBACK_CACHE_SIZE', '512')), ttl)]
+    if os.environ.get('CLAIRE_CALLBACK_CACHE_DIR'):
+        backends.append(FileCache(os.environ['CLAIRE_CALLBACK_CACHE_DIR'],
+                                  int(os.environ.get('CLAIRE_CALLBACK_CACHE_FILES', '2048')), ttl))
+    return Memo(backends, version)
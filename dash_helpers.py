@@ -1,37 +1,272 @@
 import pandas as pd
 import numpy as np
 from collections import Counter
-import plotly.express as px
-import plotly.graph_objects as go
-import plotly.figure_factory as ff
-import emoji
-import regex
+from itertools import chain
+import weakref
+import threading
 import re
-from nltk.util import ngrams
+import dash_metrics as metrics
+from dash_cache import LRUCache
 
-def plot_by_day(df, smooth = 1):
+# plotly.express, emoji and regex are slow to import and only needed once a
+# figure is drawn or emojis are counted, so they are imported where used.
 
-    plot_df = df.groupby(['Day', 'Type'])\
-                .apply(len).ewm(span = smooth)\
-                .mean()\
-                .reset_index()\
-                .rename(columns = {0: 'smoothed count'})
+############
+# Cleaning #
+############
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+SENDERS = {'Incoming': 'Claire', 'Outgoing': 'Gabe'}
+DEFAULT_SENDER = 'Gabe'
+### One colour per sender, in category order
+SENDER_COLORS = ['pink', 'blue', 'orange', 'green', 'purple', 'brown', 'gray', 'olive', 'cyan', 'red']
+
+def parse_dates(dates, fmt = DATE_FORMAT):
+    parsed = pd.to_datetime(dates, format = fmt, errors = 'coerce')
+    ### Anything not in the export's usual format goes through the slow generic parser
+    missed = parsed.isnull() & dates.notnull()
+    if missed.any():
+        parsed[missed] = pd.to_datetime(dates[missed])
+    return parsed
+
+def sender_dtype(senders = SENDERS, default = DEFAULT_SENDER):
+    ### Sender names as a fixed categorical, so every chunk of a conversation codes them alike
+    return pd.CategoricalDtype(list(dict.fromkeys(list(senders.values()) + [default])))
+
+def clean_messages(df, senders = SENDERS, default = DEFAULT_SENDER):
+    ### `senders` maps the export's Type values to sender names, anything else is `default`
+    df['Message Date'] = parse_dates(df['Message Date'])
+    df['Type'] = df['Type'].map(senders).fillna(default).astype(sender_dtype(senders, default))
+    df['Text'] = df['Text'].str.replace('“.*?”', '', regex = True)
+    return df
+
+##########
+# Tokens #
+##########
+
+_FRAME_CACHE = {}
+
+def frame_cache(df):
+    ### Memo dict tied to one DataFrame, dropped when the frame is garbage collected
+    key = id(df)
+    entry = _FRAME_CACHE.get(key)
+    if entry is None or entry[0]() is not df:
+        def drop(ref, key = key):
+            if _FRAME_CACHE.get(key, (None,))[0] is ref:
+                del _FRAME_CACHE[key]
+        entry = _FRAME_CACHE[key] = (weakref.ref(df, drop), {})
+    return entry[1]
+
+def cached(df, name, build):
+    cache = frame_cache(df)
+    if name not in cache:
+        cache[name] = build(df)
+    return cache[name]
+
+class TokenIndex:
+    # Lower-cased, whitespace-split tokens of every message, encoded once.
+    # Messages are stably ordered by sender so each sender's tokens are one
+    # contiguous slice of `ids`; `offsets` bound each message in that order
+    # and `lengths` holds token counts in the original row order.
+
+    def __init__(self, df):
+        senders = df['Type'].astype('category')
+        self.senders = list(senders.cat.categories)
+        codes = senders.cat.codes.to_numpy()
+        self.order = np.argsort(codes, kind = 'stable')
+
+        tokens = df['Text'].fillna('').str.lower().str.split()
+        self.lengths = tokens.str.len().to_numpy().astype('int32')
+        ids, self.vocab = pd.factorize(np.fromiter(chain.from_iterable(tokens.iloc[self.order]), dtype = object,
+                                                   count = self.lengths.sum()))
+        self.ids = ids.astype('int32')
+        self.offsets = np.concatenate([[0], np.cumsum(self.lengths[self.order])])
+
+        bounds = np.searchsorted(codes[self.order], np.arange(len(self.senders) + 1))
+        self.spans = {p: (bounds[i], bounds[i + 1]) for i, p in enumerate(self.senders)}
+
+    def sender_ids(self, person):
+        lo, hi = self.spans[person]
+        return self.ids[self.offsets[lo]:self.offsets[hi]]
+
+    def counts(self, person):
+        return np.bincount(self.sender_ids(person), minlength = len(self.vocab))
+
+def token_index(df):
+    return cached(df, 'tokens', TokenIndex)
+
+def token_rows(df):
+    ### The DataFrame row of every token, in token_index order
+    def build(df):
+        idx = token_index(df)
+        return np.repeat(idx.order, idx.lengths[idx.order])
+    return cached(df, 'token_rows', build)
+
+_SPACES = None
+
+def whitespace_table():
+    ### Lookup of every code point str.split() treats as whitespace
+    global _SPACES
+    if _SPACES is None:
+        spaces = [c for c in range(0x3001) if chr(c).isspace()]
+        _SPACES = np.zeros(0x3002, dtype = bool)
+        _SPACES[spaces] = True
+    return _SPACES
+
+def count_words(texts, chunk = 1 << 14):
+    ### Whitespace-separated words in each of `texts` (NaN counts 0) without
+    ### splitting any of them: messages are joined into one code point array per
+    ### chunk and every non-space that follows a space or a message start begins a word
+    table = whitespace_table()
+    counts = np.zeros(len(texts), dtype = 'int64')
+    for lo in range(0, len(texts), chunk):
+        part = texts[lo:lo + chunk]
+        ok = np.flatnonzero(pd.notnull(part))
+        strs = part[ok]
+        lengths = np.fromiter(map(len, strs), dtype = 'int64', count = len(strs))
+        cps = np.frombuffer(''.join(strs).encode('utf-32-le'), dtype = np.uint32)
+        space = table[np.minimum(cps, len(table) - 1)]
+        ends = np.cumsum(lengths)
+        begins = np.zeros(len(cps), dtype = bool)
+        begins[(ends - lengths)[lengths > 0]] = True
+        start = ~space & (begins | np.concatenate([[True], space[:-1]]))
+        msg = np.searchsorted(ends, np.flatnonzero(start), side = 'right')
+        counts[lo + ok] = np.bincount(msg, minlength = len(strs))
+    return counts
+
+def word_counts(df):
+    ### Words per message in row order, in the smallest unsigned dtype that fits.
+    ### Reuses the token index if one was built, otherwise counts in place
+    def build(df):
+        cache = frame_cache(df)
+        if 'tokens' in cache:
+            counts = cache['tokens'].lengths
+        else:
+            counts = count_words(df['Text'].to_numpy())
+        return counts.astype(np.min_scalar_type(int(counts.max(initial = 0))))
+    return cached(df, 'word_counts', build)
+
+################
+# Aggregations #
+################
+
+# Every count below is one np.bincount over integer-coded keys (day offset,
+# hour or length) combined with the sender's category code, giving a dense
+# key x sender table with no Python call per group.
+
+def count_by(keys, size, codes, k, weights = None):
+    ### (size x k) counts, or sums of `weights`, for keys in [0, size) and sender codes in [0, k)
+    flat = np.bincount(keys * k + codes, weights = weights, minlength = size * k)
+    return flat[:size * k].reshape(size, k)
+
+def sender_codes(df):
+    senders = df['Type'].astype('category')
+    return list(senders.cat.categories), senders.cat.codes.to_numpy().astype('int64')
+
+def day_offsets(dates):
+    ### Every day from the first of `dates` to the last, and each date's offset from the first (-1 if NaT)
+    dates = np.asarray(dates).astype('datetime64[D]')
+    ok = ~np.isnat(dates)
+    if not ok.any():
+        return pd.DatetimeIndex([]), np.full(len(dates), -1, dtype = 'int64')
+    first = dates[ok].min()
+    day = np.where(ok, (dates - first).astype('int64'), -1)
+    return pd.date_range(first, periods = int(day.max()) + 1, freq = 'D'), day
+
+def day_codes(df):
+    ### Day offset of every message from the first day, -1 where the date is missing
+    return cached(df, 'days', lambda df: day_offsets(df['Message Date'].to_numpy()))
+
+def daily_counts(df):
+    ### Dense day x sender message counts, with zero rows for days nobody texted
+    def build(df):
+        days, day = day_codes(df)
+        senders, codes = sender_codes(df)
+        ok = day >= 0
+        return days, senders, count_by(day[ok], len(days), codes[ok], len(senders))
+    return cached(df, 'daily', build)
+
+def hourly_counts(df):
+    senders, codes = sender_codes(df)
+    hours = df['Hour'].to_numpy()
+    ok = ~pd.isnull(hours)
+    return np.arange(24), senders, count_by(hours[ok].astype('int64'), 24, codes[ok], len(senders))
+
+def long_counts(keys, senders, counts, key_name, value_name):
+    ### Sender-major long frame of the non-zero cells of a key x sender table
+    rows, cols = np.nonzero(counts.T)
+    return pd.DataFrame({key_name: np.asarray(keys)[cols],
+                         'Type': np.asarray(senders, dtype = object)[rows],
+                         value_name: counts.T[rows, cols]})
+
+def ewm_mean(counts, span):
+    ### pandas' adjusted ewm(span).mean() down each column, as a short loop over rows
+    w = 1 - 2 / (span + 1)
+    out = np.empty(counts.shape, dtype = 'float64')
+    num = np.zeros(counts.shape[1:])
+    den = 0.0
+    for i, row in enumerate(counts):
+        num = row + w * num
+        den = 1 + w * den
+        out[i] = num / den
+    return out
+
+def minmax_indices(y, points):
+    ### Positions of the lowest and highest value in each of points / 2 equal
+    ### buckets, plus both ends, so peaks survive; all of them if y is short
+    n = len(y)
+    if n <= points:
+        return np.arange(n)
+    bucket = np.arange(n) * max(points // 2, 1) // n
+    order = np.lexsort((y, bucket))
+    starts = np.flatnonzero(np.diff(bucket[order], prepend = -1))
+    ends = np.append(starts[1:], n) - 1
+    return np.unique(np.concatenate([[0, n - 1], order[starts], order[ends]]))
+
+def day_series(days, counts, smooth = 1, points = None, window = None):
+    ### Smoothed counts per sender as (days, values), cut to the dates in `window`
+    ### (plus one day either side) and downsampled to about `points` per sender.
+    ### Smoothing runs over the full history so a zoomed view matches the whole.
+    smoothed = ewm_mean(counts, smooth)
+    days = np.asarray(days, dtype = 'datetime64[D]')
+    lo, hi = 0, len(days)
+    if window is not None:
+        lo = max(np.searchsorted(days, np.datetime64(window[0], 'D')) - 1, 0)
+        hi = min(np.searchsorted(days, np.datetime64(window[1], 'D'), side = 'right') + 1, len(days))
+    series = []
+    for col in smoothed[lo:hi].T:
+        idx = minmax_indices(col, points) if points else np.arange(len(col))
+        series.append((days[lo:hi][idx], col[idx]))
+    return series
+
+@metrics.builder
+def day_fig(days, senders, counts, smooth = 1, points = None):
+    import plotly.express as px
+    series = day_series(days, counts, smooth, points)
+
+    plot_df = pd.DataFrame({'Day': np.concatenate([x for x, _ in series]) if series else [],
+                            'Type': np.repeat(senders, [len(x) for x, _ in series]),
+                            'smoothed count': np.concatenate([y for _, y in series]) if series else []})
     
     fig = px.line(plot_df, x='Day', y='smoothed count', color = 'Type',
-                 color_discrete_sequence=['pink', 'blue'],
+                 color_discrete_sequence=SENDER_COLORS,
                  labels={"Type": "Lover"})
     # fig.add_trace(go.Bar(x = plot_df['Day'], y = plot_df['sum']))
+    ### Keep the user's zoom when the lines are swapped for a zoomed-in series
+    fig.update_layout(uirevision = 'day')
     
     return fig
 
-def plot_by_hour(df):
-    plot_df = df.groupby(['Hour', 'Type'])\
-                .apply(len)\
-                .reset_index()\
-                .rename(columns = {0: 'count'})
+def plot_by_day(df, smooth = 1, points = None):
+    return day_fig(*daily_counts(df), smooth, points)
+
+@metrics.builder
+def hour_fig(hours, senders, counts):
+    import plotly.express as px
+    plot_df = long_counts(hours, senders, counts, 'Hour', 'count')
     
     fig = px.bar(plot_df, x='Hour', y='count', color = 'Type',
-                color_discrete_sequence=['pink', 'blue'],
+                color_discrete_sequence=SENDER_COLORS,
                 labels={"Type": "Lover"})
     fig.update_layout(
         xaxis = dict(
@@ -40,72 +275,361 @@ def plot_by_hour(df):
 )
     return fig
 
-def word_cnt(x):
-    corp = x['Text'].str.cat(sep=' ')
-    corp = [i.lower() for i in corp.split()]
-    return pd.Series(dict(Counter(corp).most_common()))
+def plot_by_hour(df):
+    return hour_fig(*hourly_counts(df))
+
+def word_cnt(idx, person):
+    cnts = idx.counts(person)
+    used = np.flatnonzero(cnts)
+    return pd.DataFrame({'person': person, 'word': idx.vocab[used], 'count': cnts[used]})
 
 def words_table(df):
-    cnts = df.groupby('Type').apply(word_cnt).reset_index()
-    cnts.columns = ['person', 'word', 'count']
+    idx = token_index(df)
+    cnts = pd.concat([word_cnt(idx, p) for p in idx.senders], ignore_index = True)
     
-    return cnts.sort_values('count', ascending = False)
+    return cnts.sort_values('count', ascending = False, kind = 'stable')
 
-def text_length(df):
-    plot_df = df.copy()
-    plot_df['length'] = plot_df.Text.fillna('').apply(lambda x: x.split()).apply(len)
-    plot_df = plot_df.loc[plot_df.Type != 'Notification', :].reset_index()
+def length_tables(df):
+    ### Texts per word count and words per day, both per sender
+    senders, codes = sender_codes(df)
+    length = word_counts(df).astype('int64')
     ### Drop 0 length
-    plot_df = plot_df.loc[plot_df.length > 0, : ]
-    
-    tl_plot_df = plot_df.groupby(['Type', 'length']).apply(lambda x: len(x)).reset_index().rename(columns = {0: 'count'})
+    keep = (df.Type != 'Notification').to_numpy() & (length > 0)
+    lengths = count_by(length[keep], int(length.max(initial = 0)) + 1, codes[keep], len(senders))
+
+    days, day = day_codes(df)
+    keep &= day >= 0
+    words = count_by(day[keep], len(days), codes[keep], len(senders), weights = length[keep]).astype('int64')
+    return senders, lengths, days, words
+
+def binned_histogram(plot_df, x, points):
+    ### px.histogram of plot_df[x] by Type from at most `points` shared bins per
+    ### sender instead of every value; the marginal boxes get precomputed
+    ### quartiles and fences, so outlier points are no longer drawn
+    import plotly.express as px
+    edges = np.histogram_bin_edges(plot_df[x], bins = points)
+    frames, boxes = [], {}
+    for p, values in plot_df.groupby('Type', sort = False)[x]:
+        n, _ = np.histogram(values, bins = edges)
+        frames.append(pd.DataFrame({x: edges[:-1][n > 0], 'Type': p, 'n': n[n > 0]}))
+        q1, median, q3 = np.percentile(values, [25, 50, 75])
+        inside = values[(values >= q1 - 1.5 * (q3 - q1)) & (values <= q3 + 1.5 * (q3 - q1))]
+        boxes[p] = dict(q1 = [q1], median = [median], q3 = [q3], lowerfence = [inside.min()],
+                        upperfence = [inside.max()], x = None, y = [p], boxpoints = False)
+
+    fig = px.histogram(pd.concat(frames, ignore_index = True), x = x, y = 'n', histfunc = 'sum',
+                       color = 'Type', marginal = 'box',
+                       color_discrete_sequence=SENDER_COLORS,
+                       labels={"Type": "Lover"})
+    fig.update_traces(xbins = dict(start = edges[0], end = edges[-1], size = edges[1] - edges[0]),
+                      selector = dict(type = 'histogram'))
+    for trace in fig.data:
+        if trace.type == 'box':
+            trace.update(boxes[trace.name])
+    fig.update_yaxes(title_text = 'count', row = 1)
+    return fig
+
+@metrics.builder
+def length_figs(senders, lengths, days, words, points = None):
+    import plotly.express as px
+    tl_plot_df = long_counts(np.arange(len(lengths)), senders, lengths, 'length', 'count')
 
     tl_fig = px.bar(tl_plot_df, x="length", y="count",
              color="Type", barmode = 'group',
-             color_discrete_sequence=['pink', 'blue'],
+             color_discrete_sequence=SENDER_COLORS,
             labels={"Type": "Lover"})
     
     tl_fig.update_layout(xaxis_range=[0,20])
     
     ### Word per day distribution
-    wd_plot_df = plot_df.groupby(['Day', 'Type']).apply(lambda x: sum(x.length)).reset_index().rename(columns = {0: 'count'})
+    wd_plot_df = long_counts(days, senders, words, 'Day', 'count')
     
+    if points and len(wd_plot_df) > points:
+        return tl_fig, binned_histogram(wd_plot_df, 'count', points)
+
     wd_fig = px.histogram(wd_plot_df, x="count", color="Type", marginal = 'box',
-                         color_discrete_sequence=['pink', 'blue'],
+                         color_discrete_sequence=SENDER_COLORS,
                          labels={"Type": "Lover"})
     
     return tl_fig, wd_fig
 
+def text_length(df, points = None):
+    return length_figs(*length_tables(df), points)
+
+############
+# Snippets #
+############
+
+def snippet_columns(df):
+    ### Positional arrays for pulling conversation windows without per-row .loc lookups
+    def build(df):
+        names, codes = sender_codes(df)
+        return df['Day'].to_numpy(), np.asarray(names, dtype = object), codes, df['Text'].to_numpy()
+    return cached(df, 'snippets', build)
+
+def snippet(df, start, size = 10):
+    days, names, codes, texts = snippet_columns(df)
+    rows = slice(start, start + size)
+    return days[start], list(zip(names[codes[rows]], [f'{t}' for t in texts[rows]]))
+
+def sample_snippets(df, k = 120, size = 10):
+    ### k random windows packed for the browser: sender names once, then [code, text] pairs
+    days, names, codes, texts = snippet_columns(df)
+    windows = []
+    for start in np.random.randint(0, len(texts), min(k, len(texts))):
+        rows = slice(start, start + size)
+        windows.append({'day': f'{days[start]}',
+                        'messages': [[int(c), f'{t}'] for c, t in zip(codes[rows], texts[rows])]})
+    return {'senders': list(names), 'windows': windows}
+
 ##########
 # Stats ##
 ##########
 
+def game_rows(df):
+    ### 'word hunt' appears in a message's joined tokens iff some token ending in
+    ### 'word' is directly followed, in the same message, by one starting with 'hunt'
+    idx = token_index(df)
+    vocab = pd.Series(idx.vocab, dtype = object)
+    ends = vocab.str.endswith('word').to_numpy()[idx.ids[:-1]]
+    starts = vocab.str.startswith('hunt').to_numpy()[idx.ids[1:]]
+    hits = np.flatnonzero(ends & starts)
+    ### Drop pairs that straddle two messages, then count each message once
+    msg = np.searchsorted(idx.offsets, hits, side = 'right') - 1
+    msg = msg[hits + 1 < idx.offsets[msg + 1]]
+    return np.sort(idx.order[np.unique(msg)])
+
 def n_games(df):
-    return df.Text.fillna('').apply(lambda x: 'word hunt' in ' '.join([i.lower() for i in x.split()])).sum()
+    return len(game_rows(df))
 
-def agg_f(x):
+def agg_f(txts, n_texts, total_words, most_words):
+    ### txts: texts on each day the sender texted; the rest cover all of their texts
     d = {}
-    txts = x.groupby('Day').apply(len)
-    words = x.Text.fillna('').apply(lambda x: x.split()).apply(len)
-    d['Avg Texts per Day'] = txts.mean()
-    d['Most Texts in a Day'] = txts.max()
+    ### A date range can leave a sender with no texts at all
+    d['Avg Texts per Day'] = txts.mean() if len(txts) else 0
+    d['Most Texts in a Day'] = txts.max(initial = 0)
     d['Total Texts'] = txts.sum()
-    d['Avg Words per Text'] = words.mean()
-    d['Most Words in One Text'] = words.max()
-    d['Total Words'] = words.sum()
+    d['Avg Words per Text'] = total_words / n_texts if n_texts else 0
+    d['Most Words in One Text'] = most_words
+    d['Total Words'] = total_words
 
     return pd.Series(d).round().apply(lambda x: f'{int(x):,}')
 
-def get_stats(df):
-    stat_df = df.groupby('Type').apply(agg_f).transpose().reset_index()
-    stat_df.columns = ['', 'Claire', 'Gabe']
+def word_stats(df):
+    ### Texts, total words and longest text per sender
+    senders, codes = sender_codes(df)
+    words = word_counts(df).astype('int64')
+    n_texts = np.bincount(codes, minlength = len(senders))
+    total_words = np.bincount(codes, weights = words, minlength = len(senders)).astype('int64')
+    most_words = np.zeros(len(senders), dtype = 'int64')
+    np.maximum.at(most_words, codes, words)
+    return n_texts, total_words, most_words
+
+def stats_frame(senders, texts, n_texts, total_words, most_words):
+    stats = {}
+    for j, p in enumerate(senders):
+        txts = texts[:, j]
+        stats[p] = agg_f(txts[txts > 0], n_texts[j], total_words[j], most_words[j])
+
+    stat_df = pd.DataFrame(stats).reset_index()
+    stat_df.columns = [''] + list(senders)
     return stat_df
 
+def get_stats(df):
+    days, senders, texts = daily_counts(df)
+    return stats_frame(senders, texts, *word_stats(df))
+
+###############
+# Date Ranges #
+###############
+
+# Messages are kept sorted by date (undated ones first) so a date range is
+# one contiguous slice found by binary search, and the day, hour, length and
+# stats panels are answered from per-day tables with prefix sums, so any
+# range costs O(days) whatever the number of messages.
+
+def by_date(df):
+    dates = df['Message Date']
+    if dates.notnull().all() and dates.is_monotonic_increasing:
+        return df
+    out = df.sort_values('Message Date', kind = 'stable', na_position = 'first').reset_index(drop = True)
+    out.attrs = dict(df.attrs)
+    return out
+
+def message_span(df, start = None, end = None):
+    ### Rows of a by_date frame from day `start` through day `end`, as (lo, hi)
+    def build(df):
+        dates = df['Message Date'].to_numpy().astype('datetime64[D]')
+        undated = int(np.isnat(dates).sum())
+        return undated, dates[undated:]
+    undated, dates = cached(df, 'sorted_days', build)
+    lo = undated + (np.searchsorted(dates, np.datetime64(start, 'D')) if start else 0)
+    hi = undated + (np.searchsorted(dates, np.datetime64(end, 'D'), side = 'right') if end else len(dates))
+    return lo, max(lo, hi)
+
+def resize(a, rows, first):
+    ### `a` on a table of `rows` day rows: its undated row 0 stays row 0 and its
+    ### day rows start at row `first`
+    out = np.zeros((rows,) + a.shape[1:], dtype = a.dtype)
+    out[0] = a[0]
+    out[first:first + len(a) - 1] = a[1:]
+    return out
+
+def widen(a, values, used):
+    ### `a`, whose axis 1 holds the sorted `used` values, laid out over `values`
+    out = np.zeros((len(a), len(values)) + a.shape[2:], dtype = a.dtype)
+    out[:, np.searchsorted(values, used)] = a
+    return out
+
+def union_days(a, b):
+    ### Every day from the first to the last of two daily DatetimeIndexes
+    used = [d for d in (a, b) if len(d)]
+    if not used:
+        return a
+    return pd.date_range(min(d[0] for d in used), max(d[-1] for d in used), freq = 'D')
+
+def day_span(days, rng = None):
+    ### Rows [lo, hi) of a table with an undated row 0 and then a row per day of
+    ### `days`, for a (start, end) pair of day strings (either may be None)
+    if rng is None:
+        return 0, len(days) + 1
+    start, end = rng
+    days = np.asarray(days, dtype = 'datetime64[D]')
+    lo = 1 + (np.searchsorted(days, np.datetime64(start, 'D')) if start else 0)
+    hi = 1 + (np.searchsorted(days, np.datetime64(end, 'D'), side = 'right') if end else len(days))
+    return lo, max(lo, hi)
+
+def day_rows(days, dates):
+    ### Row of each of `dates` in a table laid out over `days`, 0 where it is NaT
+    dates = np.asarray(dates).astype('datetime64[D]')
+    if not len(days):
+        return np.zeros(len(dates), dtype = 'int64')
+    rows = (dates - np.datetime64(days[0].date(), 'D')).astype('int64') + 1
+    return np.where(np.isnat(dates), 0, rows)
+
+def first_row(days, index):
+    ### Row of index[0] in a table laid out over `days`
+    return 1 + (days.get_loc(index[0]) if len(index) else 0)
+
+class DayIndex:
+    # Per-day tables, each (days + 1) x ... x senders: row 0 holds undated
+    # messages and row i the day days[i - 1], with no gaps between days.
+    #   texts, words, games - messages, words and Word Hunt games per day
+    #   hours               - messages per day and hour (day x 24 x sender)
+    #   lengths             - texts per day and word count (day x length x sender),
+    #                         with a column only for each word count that occurs,
+    #                         listed in `lengths`, so one pasted essay adds one
+    #                         column rather than thousands
+    #   most                - longest text per day (max, so not prefix-summed)
+    # A range of None covers everything, undated messages included.
+
+    SUMS = ['texts', 'words', 'games', 'hours', 'lengths']
+
+    def __init__(self, days, senders, tables, lengths):
+        self.days = days
+        self.senders = senders
+        self.tables = tables
+        self.lengths = lengths
+        self._cums = None
+
+    @classmethod
+    def from_frame(cls, df):
+        senders, codes = sender_codes(df)
+        days, day = day_codes(df)
+        k, rows = len(senders), len(days) + 1
+        row = day + 1
+        words = word_counts(df).astype('int64')
+        dated = day >= 0
+        hours = np.nan_to_num(df['Hour'].to_numpy().astype('float64')).astype('int64')
+        keep = words > 0
+        lengths = np.unique(words[keep])
+        width = len(lengths)
+        column = np.searchsorted(lengths, words[keep])
+
+        most = np.zeros(rows * k, dtype = 'int64')
+        np.maximum.at(most, row * k + codes, words)
+        game = np.zeros(len(df), dtype = 'int64')
+        game[game_rows(df)] = 1
+        return cls(days, senders, {
+            'texts': count_by(row, rows, codes, k),
+            'words': count_by(row, rows, codes, k, weights = words).astype('int64'),
+            'games': count_by(row, rows, codes, k, weights = game).astype('int64'),
+            'hours': count_by(day[dated] * 24 + hours[dated] + 24, rows * 24, codes[dated], k).reshape(rows, 24, k),
+            'lengths': count_by(row[keep] * width + column, rows * width, codes[keep], k).reshape(rows, width, k),
+            'most': most.reshape(rows, k),
+        }, lengths)
+
+    def merge(self, other):
+        ### Tables covering both indexes' days, summed (most: maxed) where they overlap
+        days = union_days(self.days, other.days)
+        rows = len(days) + 1
+        lengths = np.union1d(self.lengths, other.lengths)
+
+        def place(index, name):
+            table = index.tables[name]
+            if name == 'lengths':
+                table = widen(table, lengths, index.lengths)
+            return resize(table, rows, first_row(days, index.days))
+
+        tables = {name: place(self, name) + place(other, name) for name in self.SUMS}
+        tables['most'] = np.maximum(place(self, 'most'), place(other, 'most'))
+        return DayIndex(days, self.senders or other.senders, tables, lengths)
+
+    def cums(self):
+        if self._cums is None:
+            self._cums = {name: np.concatenate([np.zeros((1,) + self.tables[name].shape[1:], dtype = 'int64'),
+                                                np.cumsum(self.tables[name], axis = 0)])
+                          for name in self.SUMS}
+        return self._cums
+
+    def span(self, rng = None):
+        return day_span(self.days, rng)
+
+    def total(self, name, rng = None):
+        lo, hi = self.span(rng)
+        cum = self.cums()[name]
+        return cum[hi] - cum[lo]
+
+    def count(self, rng = None):
+        return int(self.total('texts', rng).sum())
+
+    def games(self, rng = None):
+        return int(self.total('games', rng).sum())
+
+    def daily_counts(self, rng = None):
+        lo, hi = self.span(rng)
+        lo = max(lo, 1)
+        return self.days[lo - 1:hi - 1], self.senders, self.tables['texts'][lo:hi]
+
+    def hourly_counts(self, rng = None):
+        return np.arange(24), self.senders, self.total('hours', rng)
+
+    def length_tables(self, rng = None):
+        days, senders, _ = self.daily_counts(rng)
+        lo, hi = self.span(rng)
+        ### Back to a row per word count, up to the longest text in the range
+        totals = self.total('lengths', rng)
+        used = np.flatnonzero(totals.any(axis = 1))
+        lengths = np.zeros((self.lengths[used[-1]] + 1 if len(used) else 1, len(senders)), dtype = 'int64')
+        lengths[self.lengths[used]] = totals[used]
+        return senders, lengths, days, self.tables['words'][max(lo, 1):hi]
+
+    def stats_frame(self, rng = None):
+        lo, hi = self.span(rng)
+        _, senders, texts = self.daily_counts(rng)
+        most = self.tables['most'][lo:hi].max(axis = 0, initial = 0)
+        return stats_frame(senders, texts, self.total('texts', rng), self.total('words', rng), most)
+
+def day_index(df):
+    return cached(df, 'day_index', DayIndex.from_frame)
+
 ##########
 # Emojis #
 ##########
 
 def split_count(text):
+    import emoji
+    import regex
 
     emoji_list = []
     data = regex.findall(r'\X', text)
@@ -115,41 +639,87 @@ def split_count(text):
     
     return emoji_list
 
+_EMOJI_CHARS = None
+_GRAPHEME = None
+
+def emoji_chars():
+    ### Lookup set of every single-codepoint emoji, built once
+    global _EMOJI_CHARS
+    if _EMOJI_CHARS is None:
+        import emoji
+        _EMOJI_CHARS = frozenset(c for c in emoji.UNICODE_EMOJI['en'] if len(c) == 1)
+    return _EMOJI_CHARS
+
+def grapheme_pattern():
+    global _GRAPHEME
+    if _GRAPHEME is None:
+        import regex
+        _GRAPHEME = regex.compile(r'\X')
+    return _GRAPHEME
+
+def extract_emojis(df):
+    ### Every emoji grapheme with the row it came from. Same graphemes as
+    ### split_count, but only messages that contain an emoji are segmented
+    ### and each grapheme is tested with a set lookup rather than a dict scan.
+    chars = emoji_chars()
+    grapheme = grapheme_pattern()
+    rows, found = [], []
+    for i, text in enumerate(df['Text'].to_numpy()):
+        ### No emoji is ASCII, so most messages stop at isascii()
+        if not isinstance(text, str) or text.isascii() or chars.isdisjoint(text):
+            continue
+        for g in grapheme.findall(text.lower()):
+            if not chars.isdisjoint(g):
+                rows.append(i)
+                found.append(g)
+
+    return pd.DataFrame({'row': np.array(rows, dtype = 'int64'), 'emoji': np.array(found, dtype = object)})
+
+def emoji_counts(df, stops = ()):
+    ### Emoji counts per sender and day, in order of first use
+    occ = cached(df, 'emojis', extract_emojis)
+    occ = occ.loc[~occ.emoji.isin(list(stops))]
+    ### Graphemes that carry whitespace count as their pieces, as the old join/split did
+    occ = occ.assign(emoji = occ.emoji.str.split()).explode('emoji').dropna()
+
+    rows = occ.row.to_numpy()
+    ### Undated messages keep their emojis, under a missing Day
+    return occ.assign(person = df['Type'].to_numpy()[rows], Day = df['Day'].to_numpy()[rows])\
+              .groupby(['person', 'Day', 'emoji'], sort = False, observed = True, dropna = False)\
+              .size()\
+              .rename('n')\
+              .reset_index()
+
+def sender_emojis(cnts, person):
+    emojis = cnts.loc[cnts.person == person]\
+                 .groupby('emoji', sort = False)['n'].sum()\
+                 .sort_values(ascending = False, kind = 'stable')\
+                 .reset_index()
+    emojis['person'] = person
+    return emojis
+
+STOP_EMOTS = ['🟨', '🟩', '⬛', '', '  ']
+
 def emoji_cnt(df):
-    claire_corpus = df.loc[df.Type == 'Claire', 'Text'].str.cat(sep=' ')
-    claire_corpus = [i.lower() for i in claire_corpus.split()]
-    
-    gabe_corpus = df.loc[df.Type == 'Gabe', 'Text'].str.cat(sep=' ')
-    gabe_corpus = [i.lower() for i in gabe_corpus.split()]
-    
-    stop_emots = ['🟨', '🟩', '⬛', '', '  ']
-    
-    ### Claire Emojis
-    emojies = split_count(' '.join(claire_corpus))
-    claire_emojis = ' '.join(emoji for emoji in emojies if emoji not in stop_emots)
-    claire_emojis = pd.DataFrame(dict(Counter(claire_emojis.split()).most_common()), index = range(1)).transpose().reset_index()
-    claire_emojis = claire_emojis.rename(columns = {'index' : 'emoji', 0 : 'n'})
-    claire_emojis['person'] = 'Claire'
-    
-    ### Gabe Emojis
-    emojies = split_count(' '.join(gabe_corpus))
-    gabe_emojis = ' '.join(emoji for emoji in emojies if emoji not in stop_emots)
-    
-    gabe_emojis = pd.DataFrame(dict(Counter(gabe_emojis.split()).most_common()), index = range(1)).transpose().reset_index()
-    gabe_emojis = gabe_emojis.rename(columns = {'index' : 'emoji', 0 : 'n'})
-    gabe_emojis['person'] = 'Gabe'
-    
+    cnts = emoji_counts(df, STOP_EMOTS)
+    senders, _ = sender_codes(df)
+    return emoji_fig(senders, [sender_emojis(cnts, p) for p in senders])
+
+@metrics.builder
+def emoji_fig(senders, emojis):
+    ### emojis: each sender's sender_emojis frame, in the order of `senders`
+    import plotly.express as px
 #     ### Emojis Fig
-    emot_df = claire_emojis.append(gabe_emojis)
-#     plot_df = claire_emojis.sort_values(by = 'n', ascending = False).iloc[:10, :]\
-#                            .append(gabe_emojis.sort_values(by = 'n', ascending = False).iloc[:10, :])
+    emot_df = pd.concat(emojis)
 
-    plot_df = claire_emojis.merge(gabe_emojis, on = 'emoji', how = 'outer', suffixes = ('Claire', 'Gabe'))
+    ### One count column per sender, the first sender's favourites first
+    plot_df = pd.DataFrame({'emoji': pd.Series(dtype = object)})
+    for p, sent in zip(senders, emojis):
+        plot_df = plot_df.merge(sent[['emoji', 'n']].rename(columns = {'n': p}), on = 'emoji', how = 'outer')
     plot_df = plot_df.iloc[:15, ]
-    plot_df = plot_df.rename(columns = {'nClaire' : 'Claire', 'nGabe' : 'Gabe'})
     
-    emot_fig = px.bar(plot_df, x="emoji", y=['Claire', 'Gabe'], barmode = 'group', 
-                      color_discrete_sequence=['pink', 'blue'],
+    emot_fig = px.bar(plot_df, x="emoji", y=list(senders), barmode = 'group', 
+                      color_discrete_sequence=SENDER_COLORS,
                 labels={"variable": "Lover"})
     
     emot_fig.update_xaxes(tickfont_size=26)
@@ -162,54 +732,145 @@ def emoji_cnt(df):
 # N-Grams #
 ###########
 
+def ngram_vocab(df):
+    return np.array([re.sub(r'[^a-zA-Z0-9\s]', '', w) for w in token_index(df).vocab], dtype = object)
+
+def window_codes(seq, n, size):
+    ### Fold one word at a time into a dense code for the window starting at each
+    ### position of seq (values in [0, size))
+    width = max(len(seq) - n + 1, 0)
+    codes = seq[:width].astype('int64')
+    for k in range(1, n):
+        codes, _ = pd.factorize(codes * size + seq[k:k + width])
+    return codes
+
+def ngram_counter(words, seq, n):
+    ### Counter of the joined n-grams of words[seq], in order of first appearance
+    codes = window_codes(seq, n, len(words))
+    if not len(codes):
+        return Counter()
+    cnt = np.bincount(codes)
+    first = np.full(len(cnt), len(codes))
+    first[codes[::-1]] = np.arange(len(codes))[::-1]
+    used = np.flatnonzero(cnt)
+    used = used[np.argsort(first[used], kind = 'stable')]
+    return Counter({' '.join(words[seq[first[c]:first[c] + n]]): int(cnt[c]) for c in used})
+
+class NgramCounts:
+    # Counts of every n-gram for one (n, stop words) pair. N-grams are coded
+    # jointly over all senders so they can be compared without decoding;
+    # `orders[p]` lists sender p's codes in Counter.most_common() order.
+
+    def __init__(self, engine, n, stops):
+        seqs = engine.sequences(stops)
+        bounds = np.cumsum([0] + [len(s) for s in seqs])
+        self.n = n
+        self.words = engine.words
+        self.cat = np.concatenate(seqs) if seqs else np.zeros(0, dtype = 'int32')
+
+        codes = window_codes(self.cat, n, len(self.words))
+        width = len(codes)
+        size = int(codes.max()) + 1 if width else 0
+
+        self.first = np.full(size, width, dtype = 'int64')
+        self.counts, self.orders = [], []
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            ### Windows that would run into the next sender's tokens are skipped
+            c = codes[lo:max(hi - n + 1, lo)]
+            pos = np.arange(lo, lo + len(c))
+            first = np.full(size, width, dtype = 'int64')
+            first[c[::-1]] = pos[::-1]
+            cnt = np.bincount(c, minlength = size).astype('int32')
+            used = np.flatnonzero(cnt)
+            self.orders.append(used[np.lexsort((first[used], -cnt[used]))])
+            self.counts.append(cnt)
+            self.first = np.minimum(self.first, first)
+
+    def decode(self, codes):
+        return [' '.join(self.words[self.cat[p:p + self.n]]) for p in self.first[codes]]
+
+class NgramEngine:
+    # Sender token streams re-encoded over the cleaned n-gram vocabulary
+    # (punctuation stripped, empty tokens dropped), with a small LRU of
+    # NgramCounts keyed on (n, stop word set), shared by request threads.
+
+    def __init__(self, df, maxsize = 16):
+        idx = token_index(df)
+        cleaned = cached(df, 'ngram_vocab', ngram_vocab)
+        keep = cleaned != ''
+        codes, self.words = pd.factorize(cleaned[keep])
+        self.words = np.asarray(self.words, dtype = object)
+        self.lookup = pd.Index(self.words)
+        word_ids = np.full(len(cleaned), -1, dtype = 'int32')
+        word_ids[keep] = codes
+
+        ### spots[i] holds where each word of seqs[i] sits in the token index
+        self.senders = idx.senders
+        self.seqs, self.spots = [], []
+        for p in self.senders:
+            seq = word_ids[idx.sender_ids(p)]
+            keep = np.flatnonzero(seq >= 0)
+            self.seqs.append(seq[keep])
+            self.spots.append(keep + idx.offsets[idx.spans[p][0]])
+
+        self._counts = LRUCache(maxsize)
+
+    def sequences(self, stops):
+        stop_ids = self.lookup.get_indexer(list(stops))
+        stop_ids = stop_ids[stop_ids >= 0]
+        if not len(stop_ids):
+            return self.seqs
+        return [s[~np.isin(s, stop_ids)] for s in self.seqs]
+
+    def counts(self, n, stops = ()):
+        key = (n, frozenset(stops))
+        found, res = self._counts.get(key)
+        if not found:
+            res = NgramCounts(self, n, stops)
+            self._counts.set(key, res)
+        return res
+
+    def warm(self, stops = (), ns = range(1, 6)):
+        for n in ns:
+            self.counts(n, stops)
+        return self
+
+    def table(self, n = 1, stops = (), top = 15):
+        ### The first sender's favourites, topped up with other senders' n-grams
+        ### when the first has fewer than `top`
+        res = self.counts(n, stops)
+        picked = np.array(pick_ngrams(res.orders, top), dtype = 'int64')
+
+        plot_df = pd.DataFrame({'ngram': res.decode(picked)})
+        for p, cnt in zip(self.senders, res.counts):
+            col = cnt[picked]
+            plot_df[p] = col if col.all() else np.where(col > 0, col, np.nan)
+        return plot_df
+
+def ngram_engine(df):
+    return cached(df, 'ngrams', NgramEngine)
+
+def pick_ngrams(ranked, top = 15):
+    ### The first sender's favourites, topped up from each other sender's ranked
+    ### n-grams in turn; `ranked` may hold lazy iterables
+    picked, seen = [], set()
+    for grams in ranked:
+        for g in grams:
+            if len(picked) >= top:
+                break
+            if g not in seen:
+                picked.append(g)
+                seen.add(g)
+    return picked
+
 def ngram_cnt(df, n = 1, stops = []):
-    claire_corpus = df.loc[df.Type == 'Claire', 'Text'].str.cat(sep=' ')
-    claire_corpus = [i.lower() for i in claire_corpus.split()]
-    
-    gabe_corpus = df.loc[df.Type == 'Gabe', 'Text'].str.cat(sep=' ')
-    gabe_corpus = [i.lower() for i in gabe_corpus.split()]
-    
-    ### Claire N-Gram
-    s = [re.sub(r'[^a-zA-Z0-9\s]', '', w) for w in claire_corpus]
-    s = [w for w in s if w not in stops]
-    s = ' '.join(s)
-    tokens = [token for token in s.split(" ") if token != ""]
-    output = list(ngrams(tokens, n))
-    claire_ngram = dict(Counter(output).most_common())
-    claire_ngram = pd.DataFrame(claire_ngram, index = range(1))\
-                     .transpose()\
-                     .reset_index()\
-                     .rename(columns = {'level_0' : 'ngram', 0 : 'n'})
-    
-    claire_ngram['ngram'] = claire_ngram.iloc[:, :n].apply(lambda x: ' '.join(x), axis=1)
-    # claire_ngram['person'] = 'Claire'
-    
-    ### Gabe N-Gram
-    s = [re.sub(r'[^a-zA-Z0-9\s]', '', w) for w in gabe_corpus]
-    s = [w for w in s if w not in stops]
-    s = ' '.join(s)
-    tokens = [token for token in s.split(" ") if token != ""]
-    output = list(ngrams(tokens, n))
-    gabe_ngram = dict(Counter(output).most_common())
-    gabe_ngram = pd.DataFrame(gabe_ngram, index = range(1))\
-                     .transpose()\
-                     .reset_index()\
-                     .rename(columns = {'level_0' : 'ngram', 0 : 'n'})
-    
-    gabe_ngram['ngram'] = gabe_ngram.iloc[:, :n].apply(lambda x: ' '.join(x), axis=1)
-    
-#     gabe_ngram['person'] = 'Gabe'
-    
-#     ### N-Gram Fig
-#     plot_df = claire_ngram.sort_values(by = 'n', ascending = False).iloc[:10, :]\
-#                            .append(gabe_ngram.sort_values(by = 'n', ascending = False).iloc[:10, :])
-
-    plot_df = claire_ngram.merge(gabe_ngram, on = 'ngram', how = 'outer', suffixes = ('Claire', 'Gabe'))
-    plot_df = plot_df.iloc[:15, ]
-    plot_df = plot_df.rename(columns = {'nClaire' : 'Claire', 'nGabe' : 'Gabe'})
-    
-    ngram_fig = px.bar(plot_df, x="ngram", y=['Claire', 'Gabe'], barmode = 'group', 
-                       color_discrete_sequence=['pink', 'blue'],
+    return ngram_fig(ngram_engine(df).table(n, stops))
+
+@metrics.builder
+def ngram_fig(plot_df):
+    import plotly.express as px
+    ngram_fig = px.bar(plot_df, x="ngram", y=list(plot_df.columns[1:]), barmode = 'group', 
+                       color_discrete_sequence=SENDER_COLORS,
                 labels={"variable": "Lover"})
     ngram_fig.update_xaxes(tickfont_size=18, tickangle = 45)
     
@@ -218,3 +879,316 @@ def ngram_cnt(df, n = 1, stops = []):
     
     
     
+
+#################
+# Term Matrices #
+#################
+
+# Sparse day x term counts for words, emojis and each n-gram length, so the
+# favourite words, emojis and n-grams of any date range are a slice and a
+# bincount over that range's rows instead of a recount of its messages.
+
+class DayTerms:
+    # One CSR matrix per sender: the terms sender p used on row i are
+    # vocab[indices[indptr[i]:indptr[i + 1]]] with counts in data. Rows are
+    # laid out as in DayIndex, row 0 holding undated messages.
+
+    def __init__(self, days, vocab, mats):
+        self.days = days
+        self.vocab = vocab
+        self.mats = mats
+
+    @classmethod
+    def from_entries(cls, days, vocab, entries):
+        ### entries maps a sender to (rows, terms, counts) arrays; repeats are summed
+        size, width = len(days) + 1, max(len(vocab), 1)
+        mats = {}
+        for p, (rows, terms, counts) in entries.items():
+            keys, inv = np.unique(rows.astype('int64') * width + terms, return_inverse = True)
+            data = np.bincount(inv, weights = counts, minlength = len(keys)).astype('int64')
+            indptr = np.searchsorted(keys // width, np.arange(size + 1))
+            mats[p] = (indptr, (keys % width).astype('int32'), data)
+        return cls(days, vocab, mats)
+
+    @classmethod
+    def from_codes(cls, days, senders, codes, rows, terms, vocab, counts = None):
+        counts = np.ones(len(terms), dtype = 'int64') if counts is None else counts
+        entries = {p: (rows[codes == i], terms[codes == i], counts[codes == i]) for i, p in enumerate(senders)}
+        return cls.from_entries(days, pd.Index(vocab, dtype = object), entries)
+
+    def entries(self, days, vocab):
+        ### Every sender's (rows, terms, counts), placed on `days` and `vocab`,
+        ### which must cover this matrix's own
+        first = first_row(days, self.days)
+        remap = vocab.get_indexer(self.vocab)
+        out = {}
+        for p, (indptr, indices, data) in self.mats.items():
+            rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+            out[p] = (np.where(rows > 0, rows + first - 1, 0), remap[indices], data)
+        return out
+
+    def merge(self, *others):
+        ### One pass over every matrix's entries, however many are merged
+        days = self.days
+        for other in others:
+            days = union_days(days, other.days)
+        ### Terms keep the order they first appear in
+        vocab = pd.Index(np.concatenate([t.vocab.to_numpy(dtype = object) for t in (self,) + others]),
+                         dtype = object).unique()
+        parts = {}
+        for t in (self,) + others:
+            for p, entries in t.entries(days, vocab).items():
+                parts.setdefault(p, []).append(entries)
+        entries = {p: tuple(np.concatenate(column) for column in zip(*found)) for p, found in parts.items()}
+        return DayTerms.from_entries(days, vocab, entries)
+
+    def counts(self, p, rng = None):
+        ### Sender p's count of every term over the days in `rng`
+        if p not in self.mats:
+            return np.zeros(len(self.vocab), dtype = 'int64')
+        indptr, indices, data = self.mats[p]
+        lo, hi = day_span(self.days, rng)
+        a, b = indptr[lo], indptr[hi]
+        return np.bincount(indices[a:b], weights = data[a:b], minlength = len(self.vocab)).astype('int64')
+
+    def ranked(self, p, rng = None):
+        ### Sender p's terms used in `rng` and their counts, most used first (ties in vocab order)
+        cnt = self.counts(p, rng)
+        used = np.flatnonzero(cnt)
+        used = used[np.argsort(-cnt[used], kind = 'stable')]
+        return self.vocab[used], cnt[used]
+
+class TermIndex:
+    # DayTerms for 'words', 'emojis' and each n-gram length n, all keyed by
+    # sender name, answering the word, emoji and n-gram tables for any range.
+    # An n-gram table is several times the size of the word table, so one
+    # that wasn't built up front is made by build(n) when first asked for.
+    # Those are left out of pickles and merges and made again after them.
+
+    def __init__(self, senders, tables, build = None):
+        self.senders = senders
+        self.tables = tables
+        self.build = build
+        self.built = set()
+        self._lock = threading.Lock()
+
+    def eager(self):
+        return {k: v for k, v in self.tables.items() if k not in self.built}
+
+    def __getstate__(self):
+        return dict(self.__dict__, tables = self.eager(), build = None, built = set(), _lock = None)
+
+    def __setstate__(self, state):
+        self.build = None
+        self.built = set()
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_frame(cls, df, ngram_ns = range(1, 6)):
+        senders, codes = sender_codes(df)
+        days, day = day_codes(df)
+        row = day + 1
+        tables = {}
+
+        idx = token_index(df)
+        tokens = token_rows(df)
+        tables['words'] = DayTerms.from_codes(days, senders, codes[tokens], row[tokens], idx.ids, idx.vocab)
+
+        emojis = emoji_counts(df, STOP_EMOTS)
+        terms, vocab = pd.factorize(emojis['emoji'])
+        tables['emojis'] = DayTerms.from_codes(days, senders, pd.Categorical(emojis['person'], senders).codes,
+                                               day_rows(days, pd.to_datetime(emojis['Day'])), terms, vocab,
+                                               emojis['n'].to_numpy())
+
+        if ngram_ns:
+            engine = ngram_engine(df)
+            for n in ngram_ns:
+                tables[n] = ngram_terms(engine, n, days, row[tokens])
+        return cls(senders, tables)
+
+    def merge(self, *others):
+        senders = list(self.senders)
+        for other in others:
+            senders += [p for p in other.senders if p not in senders]
+        eager = [t.eager() for t in (self,) + others]
+        tables = eager[0]
+        for name in set(chain.from_iterable(eager[1:])):
+            parts = [t[name] for t in eager if name in t]
+            tables[name] = parts[0].merge(*parts[1:])
+        return TermIndex(senders, tables)
+
+    def words_table(self, rng = None):
+        words = self.tables['words']
+        frames = []
+        for p in self.senders:
+            cnt = words.counts(p, rng)
+            used = np.flatnonzero(cnt)
+            frames.append(pd.DataFrame({'person': p, 'word': words.vocab[used], 'count': cnt[used]}))
+        return pd.concat(frames, ignore_index = True).sort_values('count', ascending = False, kind = 'stable')
+
+    def sender_emojis(self, p, rng = None):
+        vocab, cnt = self.tables['emojis'].ranked(p, rng)
+        return pd.DataFrame({'emoji': vocab, 'n': cnt, 'person': p})
+
+    def ngram_table(self, n = 1, stops = (), top = 15, rng = None):
+        ### As MessageSummary.ngram_table: n-grams holding a stop word are dropped
+        terms = self.ngrams(n)
+        stops = set(stops)
+        ranked = [terms.ranked(p, rng)[0] for p in self.senders]
+        picked = pick_ngrams([(g for g in grams if stops.isdisjoint(g.split())) for grams in ranked], top)
+
+        plot_df = pd.DataFrame({'ngram': picked})
+        cols = terms.vocab.get_indexer(picked)
+        for p in self.senders:
+            col = terms.counts(p, rng)[cols]
+            plot_df[p] = col if col.all() else np.where(col > 0, col, np.nan)
+        return plot_df
+
+    def ngrams(self, n):
+        if n not in self.tables:
+            with self._lock:
+                if n not in self.tables:
+                    if self.build is None:
+                        raise KeyError(n)
+                    ### Marked first, so a pickle or merge never takes it for an eager one
+                    self.built.add(n)
+                    self.tables[n] = self.build(n)
+        return self.tables[n]
+
+def ngram_terms(engine, n, days, rows):
+    ### DayTerms of the n-grams in engine's sequences, each on the day of its
+    ### first word; `rows` holds the day row of every token in the token index
+    cat = np.concatenate([np.zeros(0, dtype = 'int32')] + engine.seqs)
+    spots = np.concatenate([np.zeros(0, dtype = 'int64')] + engine.spots)
+    codes = window_codes(cat, n, len(engine.words))
+    bounds = np.cumsum([0] + [len(seq) for seq in engine.seqs])
+    ### Windows that would run into the next sender's words are skipped
+    pos = np.concatenate([np.zeros(0, dtype = 'int64')] +
+                         [np.arange(lo, max(hi - n + 1, lo)) for lo, hi in zip(bounds[:-1], bounds[1:])])
+    terms, _ = pd.factorize(codes[pos])
+    firsts = pos[np.unique(terms, return_index = True)[1]]
+    vocab = engine.words[cat[firsts]]
+    for k in range(1, n):
+        vocab = vocab + ' ' + engine.words[cat[firsts + k]]
+    senders = np.searchsorted(bounds, pos, side = 'right') - 1
+    return DayTerms.from_codes(days, engine.senders, senders, rows[spots[pos]], terms, vocab)
+
+def frame_ngrams(df):
+    ### TermIndex build for the n-gram tables of df, holding it weakly since
+    ### the index is memoized on df itself
+    ref = weakref.ref(df)
+    def build(n):
+        df = ref()
+        days, day = day_codes(df)
+        return ngram_terms(ngram_engine(df), n, days, day[token_rows(df)] + 1)
+    return build
+
+def term_index(df):
+    ### Words and emojis up front, each n-gram table on first use
+    def build(df):
+        terms = TermIndex.from_frame(df, ())
+        terms.build = frame_ngrams(df)
+        return terms
+    return cached(df, 'term_index', build)
+
+##########
+# Tables #
+##########
+
+FILTER_OPERATORS = [['ge ', '>='], ['le ', '<='], ['lt ', '<'], ['gt ', '>'], ['ne ', '!='], ['eq ', '='],
+                    ['contains '], ['datestartswith ']]
+
+def split_filter_part(filter_part):
+    ### One clause of a DataTable filter_query, e.g. '{count} >= 10' -> ('count', 'ge', 10)
+    for operator_type in FILTER_OPERATORS:
+        for operator in operator_type:
+            if operator in filter_part:
+                name_part, value_part = filter_part.split(operator, 1)
+                name = name_part[name_part.find('{') + 1: name_part.rfind('}')]
+
+                value_part = value_part.strip()
+                v0 = value_part[:1]
+                if v0 and v0 == value_part[-1] and v0 in ("'", '"', '`'):
+                    value = value_part[1:-1].replace('\\' + v0, v0)
+                else:
+                    try:
+                        value = float(value_part)
+                    except ValueError:
+                        value = value_part
+
+                return name, operator_type[0].strip(), value
+
+    return None, None, None
+
+class TableQuery:
+    # A table served to a DataTable one page at a time. Each sort order is
+    # computed once, exact matches go through a per-column position index and
+    # filter masks are memoized per query string, so paging, sorting and
+    # filtering never ship or rescan the whole table.
+
+    def __init__(self, df, maxsize = 32):
+        self.df = df.reset_index(drop = True)
+        self._orders = {}
+        self._indexes = {}
+        ### Shared by request threads, so a locked LRU
+        self._masks = LRUCache(maxsize)
+
+    def order(self, sort_by):
+        key = tuple((s['column_id'], s['direction']) for s in sort_by or [])
+        if key not in self._orders:
+            if key:
+                self._orders[key] = self.df.sort_values([c for c, _ in key], ascending = [d == 'asc' for _, d in key],
+                                                        kind = 'stable').index.to_numpy()
+            else:
+                self._orders[key] = np.arange(len(self.df))
+        return self._orders[key]
+
+    def lookup(self, col, value):
+        if col not in self._indexes:
+            self._indexes[col] = self.df.groupby(col, sort = False, observed = True).indices
+        return self._indexes[col].get(value, np.zeros(0, dtype = 'int64'))
+
+    def clause(self, col, op, value):
+        series = self.df[col]
+        numeric = pd.api.types.is_numeric_dtype(series)
+        if not numeric and isinstance(value, float):
+            value = f'{value:g}'
+        if op == 'eq' and not numeric:
+            mask = np.zeros(len(series), dtype = bool)
+            mask[self.lookup(col, str(value))] = True
+            return mask
+        if op in ('contains', 'datestartswith') or not numeric:
+            text = series.astype(str)
+            return (text.str.contains(str(value), regex = False) if op == 'contains'
+                    else text.str.startswith(str(value))).to_numpy()
+
+        ops = {'eq': np.equal, 'ne': np.not_equal, 'lt': np.less, 'le': np.less_equal,
+               'gt': np.greater, 'ge': np.greater_equal}
+        return ops[op](series.to_numpy(), value)
+
+    def mask(self, filter_query):
+        if not filter_query:
+            return None
+        found, mask = self._masks.get(filter_query)
+        if found:
+            return mask
+
+        mask = np.ones(len(self.df), dtype = bool)
+        for part in filter_query.split(' && '):
+            col, op, value = split_filter_part(part)
+            if col in self.df.columns:
+                mask &= self.clause(col, op, value)
+
+        self._masks.set(filter_query, mask)
+        return mask
+
+    def page(self, page_current = 0, page_size = 10, sort_by = None, filter_query = ''):
+        pos = self.order(sort_by)
+        mask = self.mask(filter_query)
+        if mask is not None:
+            pos = pos[mask[pos]]
+
+        start = (page_current or 0) * page_size
+        rows = self.df.iloc[pos[start:start + page_size]].to_dict('records')
+        return rows, max(-(-len(pos) // page_size), 1)
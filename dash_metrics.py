@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from functools import wraps
+
+# CLAIRE_METRICS=0 turns every timer below into a no-op, and CLAIRE_LOG_LEVEL
+# (default INFO) sets how chatty the JSON logs are. Per-request events are
+# logged at DEBUG, so they cost one level check unless asked for.
+
+ENABLED = os.environ.get('CLAIRE_METRICS', '1') != '0'
+
+##########################
+# Logging ################
+##########################
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'level': record.levelname,
+                 'logger': record.name, 'message': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default = str)
+
+log = logging.getLogger('claire')
+
+def setup_logging(level = None):
+    if log.handlers:
+        return log
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter())
+    log.addHandler(handler)
+    log.setLevel(level or os.environ.get('CLAIRE_LOG_LEVEL', 'INFO').upper())
+    log.propagate = False
+    return log
+
+def debug(message, **fields):
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(message, extra = {'fields': fields})
+
+##########################
+# Histograms #############
+##########################
+
+# Just enough of the Prometheus data model for /metrics: histograms with one
+# label, rendered in the text exposition format. Values are per process, so
+# with several workers each one reports its own.
+
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BYTES = (1_000, 10_000, 50_000, 100_000, 250_000, 500_000, 1_000_000, 2_500_000, 5_000_000, 10_000_000)
+
+class Histogram:
+    def __init__(self, name, help, label, buckets):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, label):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._series.setdefault(label, [0] * (len(self.buckets) + 1) + [0.0])
+            counts[i] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, label):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            if ENABLED:
+                self.observe(time.perf_counter() - t, label)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = {label: list(counts) for label, counts in self._series.items()}
+        for label, counts in sorted(series.items()):
+            tag = f'{self.label}="{escape(label)}"'
+            seen = 0
+            for bound, n in zip(self.buckets, counts):
+                seen += n
+                lines.append(f'{self.name}_bucket{{{tag},le="{bound}"}} {seen}')
+            seen += counts[len(self.buckets)]
+            lines.append(f'{self.name}_bucket{{{tag},le="+Inf"}} {seen}')
+            lines.append(f'{self.name}_sum{{{tag}}} {counts[-1]}')
+            lines.append(f'{self.name}_count{{{tag}}} {seen}')
+        return lines
+
+def escape(label):
+    return str(label).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def counter_lines(name, help, label, values):
+    ### A counter family from a {label value: count} dict kept elsewhere (e.g. Memo hits)
+    lines = [f'# HELP {name} {help}', f'# TYPE {name} counter']
+    lines += [f'{name}{{{label}="{escape(k)}"}} {v}' for k, v in sorted(values.items())]
+    return lines
+
+CALLBACK_SECONDS = Histogram('claire_callback_seconds', 'Dash callback request latency', 'output', SECONDS)
+CALLBACK_BYTES = Histogram('claire_callback_response_bytes', 'Serialized Dash callback response size', 'output', BYTES)
+BUILD_SECONDS = Histogram('claire_build_seconds', 'Time spent in dash_helpers figure builders', 'builder', SECONDS)
+PANEL_SECONDS = Histogram('claire_panel_seconds', 'Time to build a dashboard panel', 'panel', SECONDS)
+HISTOGRAMS = [CALLBACK_SECONDS, CALLBACK_BYTES, BUILD_SECONDS, PANEL_SECONDS]
+
+def render(extra = ()):
+    lines = [line for h in HISTOGRAMS for line in h.render()]
+    return '\n'.join(lines + list(extra)) + '\n'
+
+##########################
+# Instrumentation ########
+##########################
+
+def builder(f):
+    ### Time a figure builder under its own name
+    if not ENABLED:
+        return f
+
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        with BUILD_SECONDS.time(f.__name__):
+            return f(*args, **kwargs)
+    return wrapper
+
+def callback_output(body):
+    ### '..a.figure...b.data..' -> 'a.figure', the first output a callback request updates
+    return (body or {}).get('output', '?').strip('.').split('...')[0]
+
+def instrument_callbacks(server):
+    # Every callback goes through one Flask endpoint, so timing the request
+    # there covers all of them, including serialization, and the response
+    # body is exactly what was sent to the browser.
+    if not ENABLED:
+        return
+    from flask import g, request
+
+    @server.before_request
+    def start_callback_timer():
+        if request.path.endswith('/_dash-update-component'):
+            g.callback_start = time.perf_counter()
+
+    @server.after_request
+    def record_callback(response):
+        start = g.pop('callback_start', None)
+        if start is None:
+            return response
+        seconds = time.perf_counter() - start
+        output = callback_output(request.get_json(silent = True))
+        size = 0 if response.direct_passthrough else len(response.get_data())
+        CALLBACK_SECONDS.observe(seconds, output)
+        CALLBACK_BYTES.observe(size, output)
+        debug('callback', output = output, seconds = round(seconds, 6), bytes = size, status = response.status_code)
+        return response
@@ -0,0 +1,64 @@
+import os
+import dash_helpers as dh
+import dash_store as store
+
+# Every panel a conversation draws, by name. A builder takes `get`, which
+# returns another of the same conversation's panels by name, and the
+# conversation's source. dash_app builds them on first use from the panels
+# it holds; dash_precompute builds the table ones ahead of time, on worker
+# processes when that pays off, from the same builders.
+
+DEFAULT_STOPS = 'word hunt reversi 20 questions'
+
+### Most points per sender sent for the day lines and the words per day
+### histogram, about two per pixel of the graph's width; 0 sends everything
+PLOT_POINTS = int(os.environ.get('CLAIRE_PLOT_POINTS', '1000')) or None
+
+# CLAIRE_STREAMING=1 is for exports too big to hold in memory: the CSV is read
+# in chunks into a dash_store.MessageSummary and every panel is drawn from its
+# counts. Stop words can then only drop n-grams, not re-window around them.
+# Otherwise the messages are kept too, for exact n-grams and snippets, and
+# the summary only holds the counts that are updated on a refresh.
+
+STREAMING = os.environ.get('CLAIRE_STREAMING') == '1'
+
+PANELS = {
+    'count': lambda get, c: get('summary').total,
+    'stamp': lambda get, c: get('summary').stamp,
+    'daily': lambda get, c: get('summary').daily_counts(),
+    'hour': lambda get, c: dh.hour_fig(*get('summary').hourly_counts()),
+    'words': lambda get, c: dh.TableQuery(get('summary').words_table()),
+    'text_length': lambda get, c: dh.length_figs(*get('summary').length_tables(), PLOT_POINTS),
+    'emojis': lambda get, c: dh.emoji_fig(get('summary').senders,
+                                          [get('summary').sender_emojis(p) for p in get('summary').senders]),
+    'emoji_table': lambda get, c: dh.TableQuery(get('emojis')[1]),
+    'games': lambda get, c: get('summary').games,
+    'stats': lambda get, c: get('summary').stats_frame(),
+}
+
+### The panels built from the message table alone, heaviest first; these are
+### dash_precompute's tasks, and every other panel is quick to draw from them
+TABLE_PANELS = {}
+
+if STREAMING:
+    PANELS.update({
+        'summary': lambda get, c: store.load_summary(c),
+        'ngrams': lambda get, c: get('summary').ngram_table,
+        'terms': lambda get, c: store.summary_terms(get('summary'), c),
+    })
+else:
+    TABLE_PANELS.update({
+        ### Day x term matrices for date ranges, saved next to the column cache
+        'terms': lambda get, c: store.load_terms(get('messages'), c),
+        'summary': lambda get, c: store.MessageSummary(get('messages').attrs['stamp'], ngram_ns = (),
+                                                       terms = False).add(get('messages')),
+        ### Count every N the stop word box can ask for so callbacks only slice
+        'ngrams': lambda get, c: dh.ngram_engine(get('messages')).warm(DEFAULT_STOPS.split()).table,
+    })
+    PANELS.update(TABLE_PANELS)
+    PANELS.update({
+        ### Point CLAIRE_MESSAGES at a local CSV (or another s3:// URL) to run offline.
+        ### The cleaned columns are cached on disk and only rebuilt when the source changes.
+        ### Sorted by date so a date range is one contiguous slice of rows.
+        'messages': lambda get, c: dh.by_date(store.load_messages(c)),
+    })
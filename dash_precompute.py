@@ -0,0 +1,128 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import dash_helpers as dh
+import dash_store as store
+import dash_metrics as metrics
+from dash_panels import PANELS, TABLE_PANELS
+
+# Builds a conversation's panels up front as independent tasks: the
+# dash_panels builders that read only the message table. By default they run
+# one after another in this process. On a process pool each task runs on its
+# own and just its result is sent back. Workers don't get the table pickled:
+# they open the conversation's column cache, whose numeric columns are
+# memory-mapped, so the pages are shared through the OS page cache.
+#
+# Starting workers and sending results back costs more than the tasks save
+# unless they truly run side by side, so CLAIRE_PRECOMPUTE_WORKERS (0 by
+# default) is capped at the CPUs this process may use and fewer than two
+# runs serially. `python dash_bench.py precompute` times both ways.
+
+WORKERS = int(os.environ.get('CLAIRE_PRECOMPUTE_WORKERS', '0'))
+
+### Workers are started fresh rather than forked, since the parent may already
+### be running threads (the background loader, a server) holding locks
+START_METHOD = os.environ.get('CLAIRE_PRECOMPUTE_START', 'spawn')
+
+##########################
+# Tasks ##################
+##########################
+
+# Each task is a dash_panels table panel, so results drop straight into the
+# app's panels. The pool starts on the heaviest first.
+
+TASKS = list(TABLE_PANELS)
+
+### One table per worker process, reused by every task it is handed
+_frame = {}
+
+def frame(path, stamp):
+    if _frame.get('key') != (path, stamp):
+        _frame.clear()
+        _frame['df'] = dh.by_date(store.add_derived(store.read_columns(path)))
+        _frame['key'] = (path, stamp)
+    return _frame['df']
+
+def build(name, built, c):
+    ### Panel `name`, building the panels it reads into `built` first
+    if name not in built:
+        built[name] = PANELS[name](lambda other: build(other, built, c), c)
+    return built[name]
+
+def run_task(name, c, path, stamp):
+    ### Reading the table is timed apart, it is paid once per worker
+    t = time.perf_counter()
+    df = frame(path, stamp)
+    loaded = time.perf_counter()
+    value = build(name, {'messages': df}, c)
+    return name, value, time.perf_counter() - loaded, loaded - t, os.getpid()
+
+##########################
+# Scheduling #############
+##########################
+
+def usable_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def pool_size(tasks, workers = WORKERS):
+    ### Processes worth starting for `tasks` tasks, 0 for serial
+    size = min(workers, tasks, usable_cpus())
+    return size if size > 1 else 0
+
+def precompute(c, names = TASKS, workers = None, get = None, meanwhile = None, timings = None):
+    ### {name: value} for the tasks in `names`, on a pool of `workers`
+    ### processes (pool_size() if None, 0 for serial). Serially each task is
+    ### get(name), the caller's own panels, or else built from the column
+    ### cache; on a pool meanwhile(path) runs here while the workers do, e.g.
+    ### to read the table the caller keeps from the cache they read. If given,
+    ### `timings` is filled with each task's seconds
+    names = [name for name in TASKS if name in names]
+    if not names:
+        return {}
+    workers = pool_size(len(names)) if workers is None else workers
+    ### The caller's own panels time themselves
+    observe = workers or get is None
+    start = time.perf_counter()
+    results = {}
+
+    def record(name, value, seconds, load, pid):
+        results[name] = value
+        if timings is not None:
+            timings[name] = seconds
+        if metrics.ENABLED and observe:
+            metrics.PANEL_SECONDS.observe(seconds, name)
+        metrics.log.info('panel precomputed', extra = {'fields': {
+            'conversation': getattr(c, 'name', repr(c)), 'panel': name, 'seconds': round(seconds, 4),
+            'load_seconds': round(load, 4), 'pid': pid}})
+
+    if workers:
+        path = store.cache_path(c)
+        ### Bring the cache up to date once, before any worker reads it
+        stamp = store.refresh_cache(c, path)['stamp']
+        context = multiprocessing.get_context(START_METHOD)
+        with ProcessPoolExecutor(max_workers = min(workers, len(names)), mp_context = context) as pool:
+            futures = [pool.submit(run_task, name, c, path, stamp) for name in names]
+            if meanwhile:
+                meanwhile(path)
+            for future in as_completed(futures):
+                record(*future.result())
+    else:
+        if get is None:
+            built = {}
+            get = lambda name: build(name, built, c)
+        ### Read first, so the first task isn't charged for it
+        t = time.perf_counter()
+        get('messages')
+        load = time.perf_counter() - t
+        for name in names:
+            t = time.perf_counter()
+            value = get(name)
+            record(name, value, time.perf_counter() - t, load, os.getpid())
+
+    metrics.log.info('precompute done', extra = {'fields': {
+        'conversation': getattr(c, 'name', repr(c)), 'tasks': len(names), 'workers': workers,
+        'seconds': round(time.perf_counter() - start, 4)}})
+    return results
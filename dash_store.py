@@ -0,0 +1,902 @@
+import os
+import json
+import shutil
+import pickle
+from collections import Counter
+from contextlib import closing
+import pandas as pd
+import numpy as np
+import re
+import time
+import fcntl
+import threading
+from contextlib import contextmanager
+import dash_helpers as dh
+import dash_metrics as metrics
+
+BUCKET = 'claireandgabriel1year.com'
+MESSAGES_KEY = 'Messages - Claire Robinson.csv'
+PASS_KEYS_KEY = 'pass_keys.json'
+
+CACHE_DIR = os.environ.get('CLAIRE_CACHE_DIR', '.message_cache')
+
+### Seconds to wait on a connect or a read, how many tries a remote fetch gets
+### and the seconds a download may take in all, retries included
+FETCH_TIMEOUT = float(os.environ.get('CLAIRE_FETCH_TIMEOUT', '10'))
+FETCH_ATTEMPTS = int(os.environ.get('CLAIRE_FETCH_ATTEMPTS', '3'))
+FETCH_BUDGET = float(os.environ.get('CLAIRE_FETCH_BUDGET', '120'))
+FETCH_CHUNK = 1 << 20
+COLUMNS = ['Message Date', 'Type', 'Text']
+
+##########################
+# Sources ################
+##########################
+
+# Every source exposes a `stamp()` that changes whenever the underlying
+# object does (S3 ETag, local mtime + size) and an `open(stamp = None)`
+# returning a binary file object, so the S3 reader can be swapped for a
+# local file. Callers that just asked for the stamp pass it to open(), which
+# saves sources that need it from asking the remote again.
+
+class LocalSource:
+    def __init__(self, path):
+        self.path = path
+
+    def stamp(self):
+        st = os.stat(self.path)
+        return f'{st.st_mtime_ns}-{st.st_size}'
+
+    def open(self, stamp = None):
+        return open(self.path, 'rb')
+
+    def __repr__(self):
+        return f'LocalSource({self.path!r})'
+
+
+class S3Source:
+    # CLAIRE_S3_ENDPOINT points boto3 at another S3-compatible store, e.g. a
+    # local stand-in (MinIO, moto's server) for trying the remote path offline.
+
+    def __init__(self, bucket, key):
+        self.bucket = bucket
+        self.key = key
+
+    def _object(self):
+        import boto3
+        from botocore.config import Config
+        ### Retries are left to `retrying`, which also covers a body cut off mid-read
+        config = Config(connect_timeout = FETCH_TIMEOUT, read_timeout = FETCH_TIMEOUT,
+                        retries = {'total_max_attempts': 1})
+        s3 = boto3.resource('s3', endpoint_url = os.environ.get('CLAIRE_S3_ENDPOINT'), config = config)
+        return s3.Object(self.bucket, self.key)
+
+    def stamp(self):
+        return self._object().e_tag.strip('"')
+
+    def open(self, stamp = None):
+        return self._object().get()['Body']
+
+    def __repr__(self):
+        return f'S3Source({self.bucket!r}, {self.key!r})'
+
+
+def retrying(f, attempts = FETCH_ATTEMPTS, backoff = 0.5, deadline = None):
+    ### f(), tried again after 0.5s, 1s, ... until `attempts` have failed or
+    ### the next try would start past `deadline` (a time.monotonic() value)
+    for attempt in range(attempts):
+        try:
+            return f()
+        except Exception:
+            wait = backoff * 2 ** attempt
+            if attempt == attempts - 1 or (deadline is not None and time.monotonic() + wait >= deadline):
+                raise
+            time.sleep(wait)
+
+
+class CachedSource:
+    # A remote source read through a local copy next to the column caches.
+    # Each stamp's body is streamed to disk once, so parsing never waits on
+    # the network, and when the remote is down or a download runs past
+    # FETCH_BUDGET the last good copy is served (with its stamp) instead of
+    # failing the app. The download happens in stamp(), so the stamp it
+    # reports is always that of the copy open() serves.
+
+    def __init__(self, source):
+        self.source = source
+
+    def _path(self):
+        return cache_path(self.source) + '.raw'
+
+    def _saved_stamp(self):
+        try:
+            with open(self._path() + '.stamp') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _download(self, stamp, deadline):
+        path = self._path()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with closing(self.source.open()) as src, open(tmp, 'wb') as dst:
+                ### Each read is bounded by FETCH_TIMEOUT, so this stops at most that late
+                for block in iter(lambda: src.read(FETCH_CHUNK), b''):
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f'download of {self.source!r} ran past {FETCH_BUDGET}s')
+                    dst.write(block)
+            ### Never leave the old stamp on the new body
+            if os.path.exists(path + '.stamp'):
+                os.remove(path + '.stamp')
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        with open(path + '.stamp', 'w') as f:
+            f.write(stamp)
+
+    def _fetch(self, stamp):
+        deadline = time.monotonic() + FETCH_BUDGET
+        retrying(lambda: self._download(stamp, deadline), deadline = deadline)
+
+    def _fresh(self, stamp):
+        return stamp == self._saved_stamp() and os.path.exists(self._path())
+
+    def stamp(self):
+        ### A changed body is fetched here; if the remote can't be reached or
+        ### the fetch runs out of time, the saved copy's stamp is reported
+        try:
+            stamp = retrying(self.source.stamp)
+            if not self._fresh(stamp):
+                self._fetch(stamp)
+            return stamp
+        except Exception:
+            saved = self._saved_stamp()
+            if saved is None or not os.path.exists(self._path()):
+                raise
+            metrics.log.warning('source unreachable, serving the last good copy', exc_info = True,
+                                extra = {'fields': {'source': repr(self.source), 'stamp': saved}})
+            return saved
+
+    def open(self, stamp = None):
+        stamp = stamp or self.stamp()
+        ### Only when another process swapped in a different copy since stamp()
+        if not self._fresh(stamp):
+            self._fetch(stamp)
+        return open(self._path(), 'rb')
+
+    def __repr__(self):
+        ### The remote's, so the caches built from it keep their names
+        return repr(self.source)
+
+
+def make_source(location, default_key, cache = True):
+    ### 's3://bucket/key', a local path, or None for the default S3 object;
+    ### remote objects are read through a local copy unless `cache` is False
+    if location and not location.startswith('s3://'):
+        return LocalSource(location)
+    if not location:
+        source = S3Source(BUCKET, default_key)
+    else:
+        bucket, _, key = location[len('s3://'):].partition('/')
+        source = S3Source(bucket, key)
+    return CachedSource(source) if cache else source
+
+def messages_source():
+    return make_source(os.environ.get('CLAIRE_MESSAGES'), MESSAGES_KEY)
+
+##########################
+# Conversations ##########
+##########################
+
+# A deployment can serve several chat exports. Each is a Conversation: a
+# source plus how its Type column maps to sender names. A conversation is a
+# source itself, so every loader below takes one, and each gets its own
+# column cache and summary (its partition), keyed like its source's.
+#
+# CLAIRE_CONVERSATIONS points at a local JSON list of
+#   {"name": ..., "location": ..., "senders": {Type value: name}, "default": name}
+# with location as for CLAIRE_MESSAGES and senders/default optional
+# (dash_helpers.SENDERS). Without it the CLAIRE_MESSAGES export is the only one.
+
+DEFAULT_CONVERSATION = 'Claire & Gabe'
+
+class Conversation:
+    def __init__(self, name, source, senders = None, default = None):
+        self.name = name
+        self.source = source
+        self.senders = senders or dh.SENDERS
+        self.default = default or (dh.DEFAULT_SENDER if senders is None else list(self.senders.values())[-1])
+
+    def stamp(self):
+        return self.source.stamp()
+
+    def open(self, stamp = None):
+        return self.source.open(stamp)
+
+    def types(self):
+        return list(dh.sender_dtype(self.senders, self.default).categories)
+
+    def clean(self, df):
+        return dh.clean_messages(df, self.senders, self.default)
+
+    def __repr__(self):
+        ### The source's, so a conversation shares the cache of its bare source
+        return repr(self.source)
+
+def clean_messages(source, df):
+    ### Clean with the conversation's sender names, or the defaults for a bare source
+    return source.clean(df) if isinstance(source, Conversation) else dh.clean_messages(df)
+
+def conversations(path = None):
+    ### {name: Conversation} in the configured order
+    path = path or os.environ.get('CLAIRE_CONVERSATIONS')
+    if not path:
+        return {DEFAULT_CONVERSATION: Conversation(DEFAULT_CONVERSATION, messages_source())}
+    with open(path) as f:
+        config = json.load(f)
+    return {c['name']: Conversation(c['name'], make_source(c.get('location'), MESSAGES_KEY),
+                                    c.get('senders'), c.get('default'))
+            for c in config}
+
+def pass_keys_source():
+    ### Read from the remote every time, so the keys are never written to disk here
+    return make_source(os.environ.get('CLAIRE_PASS_KEYS'), PASS_KEYS_KEY, cache = False)
+
+def load_pass_keys(source = None):
+    source = source or pass_keys_source()
+    def read():
+        with closing(source.open()) as f:
+            return json.loads(f.read().decode('utf-8'))
+    return retrying(read)
+
+##########################
+# Derived Columns ########
+##########################
+
+def add_derived(df):
+    df['Day'] = df['Message Date'].dt.date
+    df['Time'] = df['Message Date'].dt.time
+    df['Hour'] = df['Message Date'].dt.hour
+    return df
+
+##########################
+# Columnar Cache #########
+##########################
+
+# Layout of a cache directory:
+#   meta.json  - source stamp, row count, Type categories, the watermark of
+#                the newest Message Date, the stamp of the last full ingest and
+#                where text.txt ended after each of the last few writes
+#   date.npy   - Message Date as int64 nanoseconds
+#   type.npy   - Type as int8 category codes
+#   null.npy   - bool mask of missing Text
+#   text.txt   - every Text joined by NUL, split back in a single call
+#
+# Every gunicorn worker refreshes the same directory, so writers take a file
+# lock next to it, build in a temp directory of their own and move the old
+# directory aside before renaming the new one in.
+
+TEXT_SEP = '\x00'
+CACHE_FILES = ['meta.json', 'date.npy', 'type.npy', 'null.npy', 'text.txt']
+### Writes whose text.txt end offset is kept, for workers a few refreshes behind
+TEXT_ENDS = 16
+
+def encode_columns(df, types):
+    codes = pd.Categorical(df['Type'], categories = types).codes.astype('int8')
+    text = df.Text.fillna('').astype(str).str.replace(TEXT_SEP, '', regex = False)
+    return {
+        'date.npy': df['Message Date'].to_numpy('datetime64[ns]').view('int64'),
+        'type.npy': codes,
+        'null.npy': df.Text.isnull().to_numpy(),
+    }, TEXT_SEP.join(text)
+
+def scratch_name(path, suffix):
+    return f'{path}.{os.getpid()}.{threading.get_ident()}.{suffix}'
+
+def swap_in(tmp, path):
+    ### Swap the finished directory in so readers never see a partial cache
+    old = scratch_name(path, 'old')
+    try:
+        os.replace(path, old)
+    except FileNotFoundError:
+        old = None
+    os.replace(tmp, path)
+    if old:
+        shutil.rmtree(old, ignore_errors = True)
+
+def fresh_dir(path):
+    tmp = scratch_name(path, 'tmp')
+    shutil.rmtree(tmp, ignore_errors = True)
+    os.makedirs(tmp)
+    return tmp
+
+@contextmanager
+def cache_lock(path):
+    ### One writer at a time per cache directory, across processes and threads
+    os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+    with open(path + '.lock', 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def write_columns(df, path, stamp):
+    tmp = fresh_dir(path)
+    types = list(df['Type'].astype('category').cat.categories)
+    arrays, text = encode_columns(df, types)
+
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp, name), values)
+    with open(os.path.join(tmp, 'text.txt'), 'w', encoding = 'utf-8') as f:
+        f.write(text)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump({'stamp': stamp, 'epoch': stamp, 'rows': len(df), 'types': types,
+                   'mark': watermark(df['Message Date']),
+                   'text_ends': text_ends({}, len(df), tmp)}, f)
+    swap_in(tmp, path)
+
+def append_columns(df, path, stamp):
+    ### Add rows to an existing cache without touching the rows already in it
+    meta = read_meta(path)
+    tmp = fresh_dir(path)
+    arrays, text = encode_columns(df, meta['types'])
+
+    for name, values in arrays.items():
+        np.save(os.path.join(tmp, name), np.concatenate([np.load(os.path.join(path, name), mmap_mode = 'r'), values]))
+    shutil.copyfile(os.path.join(path, 'text.txt'), os.path.join(tmp, 'text.txt'))
+    with open(os.path.join(tmp, 'text.txt'), 'a', encoding = 'utf-8') as f:
+        f.write((TEXT_SEP if meta['rows'] and len(df) else '') + text)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(dict(meta, stamp = stamp, rows = meta['rows'] + len(df),
+                       mark = watermark(df['Message Date'], meta['mark']),
+                       text_ends = text_ends(meta.get('text_ends', {}), meta['rows'] + len(df), tmp)), f)
+    swap_in(tmp, path)
+
+def text_ends(ends, rows, path):
+    ### {row count: byte length of text.txt} with this write's added, so rows
+    ### appended later can be read without splitting the ones before them
+    ends = dict(ends, **{str(rows): os.path.getsize(os.path.join(path, 'text.txt'))})
+    return dict(list(ends.items())[-TEXT_ENDS:])
+
+def read_meta(path):
+    ### None unless every column file is there, so a broken cache is rebuilt
+    if not all(os.path.exists(os.path.join(path, name)) for name in CACHE_FILES):
+        return None
+    try:
+        with open(os.path.join(path, 'meta.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def read_columns(path, start = 0):
+    ### Rows from `start` on, so a refresh can pick up just the appended ones
+    meta = read_meta(path)
+    dates = np.load(os.path.join(path, 'date.npy'), mmap_mode = 'r')[start:]
+    codes = np.load(os.path.join(path, 'type.npy'), mmap_mode = 'r')[start:]
+    null = np.load(os.path.join(path, 'null.npy'), mmap_mode = 'r')[start:]
+    text = np.array(read_text(path, meta, start), dtype = object)
+    text[null] = np.nan
+
+    df = pd.DataFrame({
+        'Message Date': pd.to_datetime(np.asarray(dates).view('datetime64[ns]')),
+        'Type': pd.Categorical.from_codes(np.asarray(codes), categories = meta['types']),
+        'Text': text,
+    })
+    ### Lets caches built from this frame tell which version of the data they saw
+    df.attrs['stamp'] = meta['stamp']
+    df.attrs['epoch'] = meta['epoch']
+    df.attrs['mark'] = meta['mark']
+    return df
+
+def read_text(path, meta, start = 0):
+    ### Texts from row `start` on, seeking past the rows before it when a write
+    ### recorded where they end
+    end = meta.get('text_ends', {}).get(str(start)) if start else None
+    with open(os.path.join(path, 'text.txt'), encoding = 'utf-8') as f:
+        if end is None:
+            return f.read().split(TEXT_SEP)[start:] if meta['rows'] else []
+        if meta['rows'] == start:
+            return []
+        f.seek(end)
+        ### Skip the separator that joined the appended rows to the earlier ones
+        return f.read()[1:].split(TEXT_SEP)
+
+def cache_path(source):
+    name = re.sub(r'[^A-Za-z0-9._-]+', '_', repr(source))
+    return os.path.join(CACHE_DIR, name)
+
+def ingest(source, path = None, stamp = None):
+    ### Parse and clean the raw CSV once, then write the columnar cache
+    path = path or cache_path(source)
+    stamp = stamp or source.stamp()
+    with closing(source.open(stamp)) as f:
+        df = pd.read_csv(f, usecols = COLUMNS)
+    write_columns(clean_messages(source, df), path, stamp)
+    return path
+
+def refresh_cache(source = None, path = None):
+    ### Bring the cache up to date with the source, cleaning only the rows past
+    ### the watermark when the source has just grown; returns the new meta
+    source = source or messages_source()
+    path = path or cache_path(source)
+    with cache_lock(path):
+        ### Read under the lock, another worker may have just refreshed it
+        meta = read_meta(path)
+        if meta is not None and isinstance(source, Conversation) and meta['types'] != source.types():
+            ### The sender names changed, so the stored codes mean something else
+            meta = None
+        try:
+            stamp = source.stamp()
+            if meta is not None and meta['stamp'] == stamp:
+                return meta
+
+            delta = read_new_messages(source, meta['mark'], stamp = stamp) if meta and 'mark' in meta else None
+            if delta is None:
+                ingest(source, path, stamp)
+            else:
+                append_columns(delta, path, stamp)
+        except Exception:
+            ### Keep serving the columns already cached until the source can be read again
+            if meta is None:
+                raise
+            metrics.log.warning('source read failed, serving the cached columns', exc_info = True,
+                                extra = {'fields': {'source': repr(source), 'stamp': meta['stamp']}})
+            return meta
+        return read_meta(path)
+
+def load_messages(source = None, path = None):
+    source = source or messages_source()
+    path = path or cache_path(source)
+    refresh_cache(source, path)
+    return add_derived(read_columns(path))
+
+##########################
+# Chunked Ingest #########
+##########################
+
+# For exports larger than memory: the CSV is read and cleaned a chunk at a
+# time and each chunk is folded into a MessageSummary of mergeable counts,
+# which is all the dashboard panels need.
+#
+# Distinct n-grams grow with the history, so each sender's counts per n are
+# cut back to the NGRAM_KEEP most common whenever they reach twice that.
+# Only the top few are ever drawn, but an n-gram that was cut and comes back
+# restarts from 0, so counts outside the head can be low.
+#
+# The day x term matrices for date ranges hold words and emojis, and the
+# n-gram lengths listed in CLAIRE_TERM_NGRAMS (e.g. '2,3'; none by default).
+# Any other n is made on first use by one more pass over the source.
+
+CHUNK_ROWS = int(os.environ.get('CLAIRE_CHUNK_ROWS', '250000'))
+NGRAM_NS = range(1, 6)
+NGRAM_KEEP = int(os.environ.get('CLAIRE_NGRAM_KEEP', '20000'))
+TERM_NGRAM_NS = tuple(int(n) for n in os.environ.get('CLAIRE_TERM_NGRAMS', '').split(',') if n.strip())
+### Chunks' term matrices waiting to be merged, at most
+TERM_FOLD = 8
+SNIPPETS = 120
+SNIPPET_SIZE = 10
+
+def iter_messages(source, chunksize = CHUNK_ROWS, stamp = None):
+    with closing(source.open(stamp)) as f:
+        for chunk in pd.read_csv(f, usecols = COLUMNS, chunksize = chunksize):
+            yield add_derived(clean_messages(source, chunk))
+
+class MessageSummary:
+    # Counts that can be built chunk by chunk (add) or combined across
+    # partial summaries (merge), and answered in the same shapes the
+    # DataFrame helpers in dash_helpers produce.
+
+    ### Bumped when the fields change, so older pickles are rebuilt
+    LAYOUT = 6
+
+    def __init__(self, stamp = None, ngram_ns = NGRAM_NS, terms = True, term_ns = TERM_NGRAM_NS):
+        self.layout = self.LAYOUT
+        self.stamp = stamp
+        self.ngram_ns = ngram_ns
+        self.track_terms = terms
+        self.term_ns = tuple(n for n in term_ns if n in ngram_ns)
+        self.mark = watermark(pd.Series([], dtype = 'datetime64[ns]'))
+        self.senders = None
+        self.days = None
+        self._terms = []
+        self.words = {}
+        self.emojis = {}
+        self.ngrams = {}
+        self.heads = {}
+        self.tails = {}
+        self.snippets = []
+
+    def _sender(self, table, p):
+        return table.setdefault(p, Counter())
+
+    def add(self, chunk):
+        senders, codes = dh.sender_codes(chunk)
+        self.senders = self.senders or senders
+        self.mark = watermark(chunk['Message Date'], self.mark)
+        days = dh.DayIndex.from_frame(chunk)
+        self.days = self.days.merge(days) if self.days else days
+
+        idx = dh.token_index(chunk)
+        for p in senders:
+            cnts = idx.counts(p)
+            used = np.flatnonzero(cnts)
+            self._sender(self.words, p).update(dict(zip(idx.vocab[used], cnts[used].tolist())))
+
+        emojis = dh.emoji_counts(chunk, dh.STOP_EMOTS)
+        for p in senders:
+            ### In order of first use, so most_common() breaks ties as sender_emojis does
+            used = emojis.loc[emojis.person == p].groupby('emoji', sort = False)['n'].sum()
+            self._sender(self.emojis, p).update(used.to_dict())
+
+        bridged = self._add_ngrams(dh.ngram_engine(chunk), chunk) if self.ngram_ns else []
+        self._prune_ngrams()
+        if self.track_terms:
+            self._add_terms(dh.TermIndex.from_frame(chunk, self.term_ns), bridged)
+        self._add_snippets(chunk, senders, codes)
+        return self
+
+    def _bridge(self, p, tail, head):
+        ### Count the n-grams that start in `tail` and end in `head` and return
+        ### them as (sender, n, day, n-gram) for the term matrices
+        bridged = bridge_grams(p, tail, head, self.ngram_ns)
+        for _, n, _, gram in bridged:
+            self._sender(self.ngrams, (p, n))[gram] += 1
+        return bridged
+
+    def _add_ngrams(self, engine, chunk):
+        ### Each sender's last few words are carried into the next chunk so
+        ### n-grams spanning a chunk boundary are counted exactly once
+        bridged = []
+        for p, (head, tail) in token_ends(engine, chunk, max(self.ngram_ns) - 1).items():
+            bridged += self._join(p, head, tail)
+        for p, seq in zip(engine.senders, engine.seqs):
+            for n in self.ngram_ns:
+                self._sender(self.ngrams, (p, n)).update(dh.ngram_counter(engine.words, seq, n))
+        return bridged
+
+    def _prune_ngrams(self):
+        ### Survivors stay in first-seen order, which breaks ties in the tables
+        for key, grams in self.ngrams.items():
+            if len(grams) >= 2 * NGRAM_KEEP:
+                keep = {g for g, _ in grams.most_common(NGRAM_KEEP)}
+                self.ngrams[key] = Counter({g: c for g, c in grams.items() if g in keep})
+
+    def _join(self, p, head, tail):
+        keep = max(self.ngram_ns) - 1
+        before = self.tails.get(p, [])
+        bridged = self._bridge(p, before, head)
+        self.heads[p] = (self.heads.get(p, []) + head)[:keep]
+        self.tails[p] = (before + tail)[-keep:]
+        return bridged
+
+    def _add_terms(self, terms, bridged):
+        ### Kept aside and merged TERM_FOLD chunks at a time; merging per chunk
+        ### would redo every earlier chunk's entries each time
+        if terms is None:
+            return
+        self._terms.append(terms)
+        if bridged and self.term_ns:
+            self._terms.append(bridge_terms(self.senders, bridged, self.term_ns))
+        if len(self._terms) > TERM_FOLD:
+            self.terms
+
+    @property
+    def terms(self):
+        if len(self._terms) > 1:
+            self._terms = [self._terms[0].merge(*self._terms[1:])]
+        return self._terms[0] if self._terms else None
+
+    def __getstate__(self):
+        ### Pickle the merged matrices, so loading doesn't redo the merge
+        self.terms
+        return self.__dict__
+
+    def _add_snippets(self, chunk, senders, codes):
+        ### Keep the SNIPPETS windows with the highest random priority seen so far,
+        ### a uniform sample of windows that merges by taking the top again
+        starts = np.arange(max(len(chunk) - SNIPPET_SIZE + 1, 0))
+        priority = np.random.random(len(starts))
+        best = starts[np.argsort(-priority)[:SNIPPETS]]
+        texts, days = chunk['Text'].to_numpy(), chunk['Day'].to_numpy()
+        for start in best:
+            rows = slice(start, start + SNIPPET_SIZE)
+            self.snippets.append((priority[start], {
+                'day': f'{days[start]}',
+                'messages': [[int(c), f'{t}'] for c, t in zip(codes[rows], texts[rows])]}))
+        self.snippets = sorted(self.snippets, key = lambda s: -s[0])[:SNIPPETS]
+
+    def merge(self, other):
+        ### Fold a summary of later messages into this one
+        self.senders = self.senders or other.senders
+        self.mark = merge_marks(self.mark, other.mark)
+        if other.days:
+            self.days = self.days.merge(other.days) if self.days else other.days
+        ### Bridge n-grams across the boundary before adding the later counts, so
+        ### ties keep first-appearance order
+        bridged = []
+        for p in other.heads:
+            bridged += self._join(p, other.heads[p], other.tails[p])
+        if self.track_terms:
+            self._add_terms(other.terms, bridged)
+        for table in ['words', 'emojis', 'ngrams']:
+            for key, counts in getattr(other, table).items():
+                self._sender(getattr(self, table), key).update(counts)
+        self._prune_ngrams()
+        self.snippets = sorted(self.snippets + other.snippets, key = lambda s: -s[0])[:SNIPPETS]
+        self.stamp = other.stamp or self.stamp
+        return self
+
+    ### Tables in the shapes the dash_helpers figure builders take, over a
+    ### (start, end) range of days or everything if rng is None
+
+    @property
+    def total(self):
+        return self.days.count() if self.days else 0
+
+    @property
+    def games(self):
+        return self.days.games() if self.days else 0
+
+    def daily_counts(self, rng = None):
+        return self.days.daily_counts(rng)
+
+    def hourly_counts(self, rng = None):
+        return self.days.hourly_counts(rng)
+
+    def length_tables(self, rng = None):
+        return self.days.length_tables(rng)
+
+    def stats_frame(self, rng = None):
+        return self.days.stats_frame(rng)
+
+    ### Word, emoji and n-gram tables come from the Counters for the whole
+    ### history and from the term matrices for a range
+
+    def words_table(self, rng = None):
+        if rng is not None:
+            return self.terms.words_table(rng)
+        frames = [pd.DataFrame({'person': p, 'word': list(self.words.get(p, {})),
+                                'count': list(self.words.get(p, {}).values())}) for p in self.senders]
+        return pd.concat(frames, ignore_index = True).sort_values('count', ascending = False, kind = 'stable')
+
+    def sender_emojis(self, p, rng = None):
+        if rng is not None:
+            return self.terms.sender_emojis(p, rng)
+        emojis = pd.DataFrame(self.emojis.get(p, Counter()).most_common(), columns = ['emoji', 'n'])
+        emojis['person'] = p
+        return emojis
+
+    def ngram_table(self, n = 1, stops = (), top = 15, rng = None):
+        ### Stop words can only be applied after counting here, so n-grams that
+        ### contain one are dropped rather than re-windowed around it
+        if rng is not None:
+            return self.terms.ngram_table(n, stops, top, rng)
+        stops = set(stops)
+        ranked = [(g for g, _ in self.ngrams.get((p, n), Counter()).most_common() if stops.isdisjoint(g.split()))
+                  for p in self.senders]
+        picked = dh.pick_ngrams(ranked, top)
+
+        plot_df = pd.DataFrame({'ngram': picked})
+        for p in self.senders:
+            grams = self.ngrams.get((p, n), Counter())
+            plot_df[p] = [grams[g] if grams[g] else np.nan for g in picked]
+        return plot_df
+
+    def snippet_payload(self):
+        return {'senders': list(self.senders), 'windows': [w for _, w in self.snippets]}
+
+def token_ends(engine, chunk, keep):
+    ### {sender: (head, tail)}, their first and last `keep` words in chunk as
+    ### (word, day) pairs, the day None where the message is undated
+    days, day = dh.day_codes(chunk)
+    names = np.append(np.asarray(days.strftime('%Y-%m-%d'), dtype = object), None)
+    token_days = names[day[dh.token_rows(chunk)]]
+    ends = {}
+    for p, seq, spots in zip(engine.senders, engine.seqs, engine.spots):
+        head, tail = [list(zip(engine.words[seq[end]], token_days[spots[end]]))
+                      for end in [slice(0, keep), slice(max(len(seq) - keep, 0), len(seq))]]
+        ends[p] = (head, tail)
+    return ends
+
+def bridge_grams(p, tail, head, ngram_ns):
+    ### (sender, n, day, n-gram) for the n-grams that start in `tail` and end in
+    ### `head`, the last and first (word, day) pairs of two consecutive
+    ### stretches of sender p's messages
+    bridge = tail + head
+    bridged = []
+    for n in ngram_ns:
+        for i in range(len(tail)):
+            if len(tail) < i + n <= len(bridge):
+                bridged.append((p, n, bridge[i][1], ' '.join(w for w, _ in bridge[i:i + n])))
+    return bridged
+
+def bridge_terms(senders, bridged, ngram_ns):
+    ### TermIndex of the n-grams _bridge found, from (sender, n, day, n-gram) tuples
+    tables = {}
+    for n in ngram_ns:
+        found = [b for b in bridged if b[1] == n]
+        days, day = dh.day_offsets(pd.to_datetime([b[2] for b in found]).to_numpy())
+        terms, vocab = pd.factorize(pd.Series([b[3] for b in found], dtype = object))
+        codes = pd.Categorical([b[0] for b in found], categories = senders).codes
+        tables[n] = dh.DayTerms.from_codes(days, senders, codes, day + 1, terms, vocab)
+    return dh.TermIndex(senders, tables)
+
+def source_ngrams(source, rows = None, chunksize = CHUNK_ROWS):
+    ### TermIndex build making the n-gram table of the first `rows` messages
+    ### of source (all of them if None) in one pass, chunks joined as in
+    ### MessageSummary
+    def build(n):
+        parts, tails, senders, seen = [], {}, [], 0
+        for chunk in iter_messages(source, chunksize):
+            if rows is not None:
+                chunk = chunk.iloc[:rows - seen]
+            if not len(chunk):
+                break
+            seen += len(chunk)
+            engine = dh.ngram_engine(chunk)
+            days, day = dh.day_codes(chunk)
+            senders += [p for p in engine.senders if p not in senders]
+            parts.append(dh.TermIndex(engine.senders, {n: dh.ngram_terms(engine, n, days, day[dh.token_rows(chunk)] + 1)}))
+            bridged = []
+            for p, (head, tail) in token_ends(engine, chunk, n - 1).items() if n > 1 else []:
+                before = tails.get(p, [])
+                bridged += bridge_grams(p, before, head, (n,))
+                tails[p] = (before + tail)[-(n - 1):]
+            if bridged:
+                parts.append(bridge_terms(senders, bridged, (n,)))
+            if len(parts) > TERM_FOLD:
+                parts = [parts[0].merge(*parts[1:])]
+        return parts[0].merge(*parts[1:]).tables[n]
+    return build
+
+def summary_terms(summary, source, chunksize = CHUNK_ROWS):
+    ### summary.terms, making the n-gram tables it doesn't hold from the
+    ### messages the summary has seen
+    terms = summary.terms
+    if terms is not None and terms.build is None:
+        terms.build = source_ngrams(source, summary.mark['rows'], chunksize)
+    return terms
+
+def summarize(source, chunksize = CHUNK_ROWS, stamp = None):
+    stamp = stamp or source.stamp()
+    summary = MessageSummary(stamp)
+    for chunk in iter_messages(source, chunksize, stamp):
+        summary.add(chunk)
+    return summary
+
+def summary_path(source):
+    return cache_path(source) + '.summary.pkl'
+
+def load_summary(source = None, path = None, chunksize = CHUNK_ROWS):
+    ### Like load_messages, but keeps only the pickled summary next to the column cache
+    source = source or messages_source()
+    path = path or summary_path(source)
+    summary = None
+    try:
+        with open(path, 'rb') as f:
+            summary = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+    if getattr(summary, 'layout', None) != MessageSummary.LAYOUT:
+        summary = None
+    elif summary.term_ns != MessageSummary(ngram_ns = summary.ngram_ns).term_ns:
+        ### CLAIRE_TERM_NGRAMS changed, so the matrices held are the wrong ones
+        summary = None
+    elif isinstance(source, Conversation) and summary.senders != source.types():
+        summary = None
+
+    stamp = source.stamp()
+    if summary is not None and summary.stamp == stamp:
+        return summary
+    summary = summary and refresh_summary(summary, source, chunksize, stamp)
+    summary = summary or summarize(source, chunksize, stamp)
+    save_summary(summary, path)
+    return summary
+
+def save_pickle(obj, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok = True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(obj, f, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+def save_summary(summary, path):
+    save_pickle(summary, path)
+
+def extend_terms(terms, df, delta, ngram_ns = NGRAM_NS):
+    ### terms of the frame `df` with the rows appended after it in `delta` folded
+    ### in, counting the n-grams that straddle the two, instead of a rebuild.
+    ### Only the n-gram tables built up front are extended, the result makes
+    ### the rest again once it is given a build
+    ngram_ns = [n for n in ngram_ns if n in terms.eager()]
+    parts = [dh.TermIndex.from_frame(delta, ngram_ns)]
+    if ngram_ns:
+        keep = max(ngram_ns) - 1
+        tails = {p: tail for p, (_, tail) in token_ends(dh.ngram_engine(df), df, keep).items()}
+        bridged = []
+        for p, (head, _) in token_ends(dh.ngram_engine(delta), delta, keep).items():
+            bridged += bridge_grams(p, tails.get(p, []), head, ngram_ns)
+        if bridged:
+            parts.append(bridge_terms(terms.senders, bridged, ngram_ns))
+    return terms.merge(*parts)
+
+def terms_path(source):
+    return cache_path(source) + '.terms.pkl'
+
+def load_terms(df, source = None, path = None):
+    ### dash_helpers.TermIndex of a load_messages frame, pickled next to its
+    ### column cache and rebuilt once the frame's stamp moves on
+    source = source or messages_source()
+    path = path or terms_path(source)
+    stamp = df.attrs['stamp']
+    try:
+        with open(path, 'rb') as f:
+            saved, terms = pickle.load(f)
+        if saved == stamp and terms.senders == list(df['Type'].cat.categories):
+            terms.build = dh.frame_ngrams(df)
+            return terms
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+        pass
+    terms = dh.term_index(df)
+    save_pickle((stamp, terms), path)
+    return terms
+
+##########################
+# Incremental Refresh ####
+##########################
+
+# Sources are treated as append-only logs. A mark records the newest Message
+# Date seen (the watermark), how many rows sat exactly on it and how many
+# rows were seen in all; a refresh cleans and counts only the rows past it.
+# If the rows up to the watermark no longer add up to `rows`, something
+# other than an append happened and callers fall back to a full rebuild.
+
+def merge_marks(a, b):
+    tops = [m['watermark'] for m in (a, b) if m['watermark'] is not None]
+    top = max(tops) if tops else None
+    return {'watermark': top,
+            'seen': sum(m['seen'] for m in (a, b) if m['watermark'] == top),
+            'rows': a['rows'] + b['rows']}
+
+def watermark(dates, mark = None):
+    ### Mark covering `dates`, appended after the rows `mark` already covers
+    stamps = dates.dropna().to_numpy('datetime64[ns]').view('int64')
+    top = int(stamps.max()) if len(stamps) else None
+    new = {'watermark': top, 'seen': int((stamps == top).sum()), 'rows': len(dates)}
+    return merge_marks(mark, new) if mark else new
+
+def read_new_messages(source, mark, chunksize = CHUNK_ROWS, stamp = None):
+    ### Cleaned rows of the source past `mark`, or None if it can't be read as an append
+    if mark['watermark'] is None:
+        return None
+    top, seen, old, new = mark['watermark'], 0, 0, []
+    with closing(source.open(stamp)) as f:
+        for chunk in pd.read_csv(f, usecols = COLUMNS, chunksize = chunksize):
+            ### Only the dates are parsed to find the new rows, the rest waits for the delta
+            dates = dh.parse_dates(chunk['Message Date'])
+            ok = dates.notnull().to_numpy()
+            stamps = dates.to_numpy('datetime64[ns]').view('int64')
+            on = ok & (stamps == top)
+            ### The first `seen` rows on the watermark are old, any after them are new
+            fresh = ok & ((stamps > top) | (on & (seen + np.cumsum(on) > mark['seen'])))
+            seen += int(on.sum())
+            old += int((~fresh).sum())
+            new.append(chunk.loc[fresh])
+    if old != mark['rows']:
+        return None
+    delta = pd.concat(new, ignore_index = True) if new else pd.DataFrame(columns = COLUMNS)
+    return add_derived(clean_messages(source, delta))
+
+def refresh_summary(summary, source, chunksize = CHUNK_ROWS, stamp = None):
+    ### Fold the rows appended since `summary` into it, or None if it needs rebuilding
+    stamp = stamp or source.stamp()
+    delta = read_new_messages(source, summary.mark, chunksize, stamp)
+    if delta is None:
+        return None
+    if len(delta):
+        summary.merge(MessageSummary(ngram_ns = summary.ngram_ns, terms = summary.track_terms,
+                                     term_ns = summary.term_ns).add(delta))
+    summary.stamp = stamp
+    return summary
@@ -0,0 +1,10 @@
+import os
+
+# Build the data once in the parent and fork workers that share it copy-on-write
+wsgi_app = 'wsgi:server'
+preload_app = True
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8050')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', os.cpu_count() or 1))
+threads = int(os.environ.get('GUNICORN_THREADS', '4'))
+timeout = 120
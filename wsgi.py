@@ -0,0 +1,4 @@
+# gunicorn -c gunicorn.conf.py
+import dash_app
+
+server = dash_app.create_server()